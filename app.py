@@ -14,13 +14,24 @@ from functools import wraps
 from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file, Response
 from werkzeug.utils import secure_filename
 import logging
+import hashlib
+import json
 import shutil
 import subprocess
+import base64
+import itertools
+import re
+import stat
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, send_file, Response, stream_with_context, Request
+from werkzeug.exceptions import UnsupportedMediaType
+from werkzeug.http import http_date, parse_date
 from werkzeug.utils import secure_filename
-from watermark_remover import WatermarkRemover
+from watermark_remover import WatermarkRemover, StageProfiler, SamplingProfiler, probe_video, configure_segment_pool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -44,45 +55,483 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 app.config['HLS_FOLDER'] = HLS_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max upload size
+app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', os.cpu_count() or 1))  # Frame worker threads per job
+app.config['PROCESSING_QUEUE_SIZE'] = int(os.environ.get('PROCESSING_QUEUE_SIZE', 16))  # Frames buffered between pipeline stages
+app.config['PROCESSING_SEGMENTS'] = int(os.environ.get('PROCESSING_SEGMENTS', os.cpu_count() or 1))  # Processes for long videos, shared by all jobs
+app.config['SEGMENT_MIN_SIZE'] = 100 * 1024 * 1024  # Uploads from 100MB are split into segments
+app.config['OUTPUT_ENCODER'] = os.environ.get('OUTPUT_ENCODER', 'ffmpeg')  # 'ffmpeg' (H.264 + original audio) or 'opencv' (mp4v)
+app.config['OUTPUT_PRESET'] = os.environ.get('OUTPUT_PRESET', 'veryfast')  # x264 preset for the ffmpeg encoder
+app.config['OUTPUT_CRF'] = int(os.environ.get('OUTPUT_CRF', 23))  # x264 quality for the ffmpeg encoder
+app.config['ROI_CACHE'] = True  # Reuse the previous result while the area around the watermark is unchanged
+app.config['ROI_CACHE_TOLERANCE'] = int(os.environ.get('ROI_CACHE_TOLERANCE', 2))  # Pixel difference still treated as unchanged
+app.config['AUTO_TIME_BUDGET'] = float(os.environ.get('AUTO_TIME_BUDGET', 600))  # Seconds of removal work an 'auto' job may use
+app.config['AUTO_MIN_FPS'] = float(os.environ['AUTO_MIN_FPS']) if os.environ.get('AUTO_MIN_FPS') else None  # Optional fps floor for 'auto'
+app.config['MAX_CONCURRENT_JOBS'] = int(os.environ.get('MAX_CONCURRENT_JOBS', 2))  # Videos processed at the same time
+app.config['MAX_QUEUED_JOBS'] = int(os.environ.get('MAX_QUEUED_JOBS', 8))  # Jobs waiting for a free worker before uploads are rejected
+app.config['HLS_RENDITIONS'] = [  # HLS ladder (name, resolution, video bitrate), largest first
+    {'name': '720p', 'resolution': '1280x720', 'bitrate': '2000k'},
+    {'name': '480p', 'resolution': '854x480', 'bitrate': '1000k'},
+    {'name': '360p', 'resolution': '640x360', 'bitrate': '500k'}
+]
+app.config['HLS_EAGER'] = True  # Package HLS in the background as soon as a job finishes
+app.config['HLS_BUILD_WORKERS'] = int(os.environ.get('HLS_BUILD_WORKERS', 1))  # Concurrent HLS packaging runs
+app.config['HLS_BUILD_TIMEOUT'] = 3600  # Seconds after which an abandoned build directory is taken over
+app.config['HLS_RETRY_AFTER'] = 5  # Seconds clients are asked to wait while a playlist is being built
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 5 * 1024 ** 3))  # Disk used by cached outputs
+app.config['RESULT_CACHE_MAX_AGE'] = 24 * 3600  # Seconds since last use before a cached output is dropped
+app.config['PROGRESS_EVENT_INTERVAL'] = 0.5  # Minimum seconds between progress events pushed to clients
+app.config['PROGRESS_KEEPALIVE'] = 15  # Seconds between keep-alive comments on idle event streams
+app.config['JOB_PROFILING'] = True  # Record per-stage timings for every job (served at /jobs/<job_id>/profile)
+app.config['JOB_SAMPLING'] = os.environ.get('JOB_SAMPLING') == '1'  # Allow uploads with profile=1 to attach a sampling profiler
+app.config['JOB_SAMPLING_INTERVAL'] = 0.005  # Seconds between stack samples of a sampled job
+app.config['VIDEO_LOG_SAMPLE_EVERY'] = 100  # Log headers of one in this many /video requests at DEBUG level
+app.config['MEDIA_OFFLOAD'] = os.environ.get('MEDIA_OFFLOAD', '')  # '' (serve from Flask), 'x-sendfile' (Apache/lighttpd) or 'x-accel' (nginx)
+app.config['MEDIA_ACCEL_PREFIX'] = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected/outputs/')  # nginx internal location aliased to OUTPUT_FOLDER
+app.config['MEDIA_MAX_AGE'] = 365 * 24 * 3600  # Cache lifetime of outputs whose name is unique to one job
+app.config['MEDIA_MAX_RANGES'] = 16  # Requests with more byte ranges than this get the whole file
+app.config['PREVIEW_SAMPLES'] = 4  # Frames shown by /preview unless the request asks for another number
+app.config['PREVIEW_MAX_SAMPLES'] = 12  # Upper limit for the samples field of /preview
+app.config['PREVIEW_MAX_WIDTH'] = 640  # Width preview frames are downscaled to
+app.config['PREVIEW_CONCURRENCY'] = 2  # Previews computed at the same time before /preview answers 503
+
+# Background processing jobs, keyed by job id
+jobs = {}
+jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=app.config['MAX_CONCURRENT_JOBS'], thread_name_prefix='job')
+
+# Processed outputs of earlier jobs, keyed by content hash + settings, least recently used first
+result_cache = OrderedDict()
+result_cache_lock = threading.Lock()
+
+# In-flight HLS builds, keyed by HLS directory name
+hls_builds = {}
+hls_builds_lock = threading.Lock()
+hls_executor = ThreadPoolExecutor(max_workers=app.config['HLS_BUILD_WORKERS'], thread_name_prefix='hls')
+
+# Segment processes of long videos come from one pool shared by all jobs
+configure_segment_pool(app.config['PROCESSING_SEGMENTS'])
+
+# Metadata of output videos, keyed by path and validated against the file's size and mtime;
+# persisted as a hidden JSON sidecar next to each video so it survives restarts
+video_index = {}
+video_index_lock = threading.Lock()
+
+# Operational metrics exported at /metrics: (name, sorted label pairs) -> value or histogram state
+METRICS = {
+    'watermark_jobs_total': ('counter', 'Jobs by removal method and outcome'),
+    'watermark_frames_processed_total': ('counter', 'Frames written by finished jobs'),
+    'watermark_processing_seconds_total': ('counter', 'Time finished jobs spent processing'),
+    'watermark_processing_fps': ('gauge', 'Frames per second of the last finished job'),
+    'watermark_roi_cache_hits_total': ('counter', 'Frames served from the ROI cache'),
+    'watermark_result_cache_lookups_total': ('counter', 'Result cache lookups by outcome'),
+    'watermark_hls_build_seconds': ('histogram', 'Duration of HLS packaging runs'),
+    'watermark_bytes_served_total': ('counter', 'Response body bytes sent per route'),
+    'watermark_jobs': ('gauge', 'Jobs currently queued or processing'),
+    'watermark_hls_builds_in_progress': ('gauge', 'HLS packaging runs queued or running'),
+    'watermark_result_cache_entries': ('gauge', 'Outputs held by the result cache'),
+}
+HLS_BUILD_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+metric_values = {}
+metric_histograms = {}
+metrics_lock = threading.Lock()
+video_log_counter = itertools.count()
+
+# Media serving: outputs are named processed_<name>_<uuid>.<ext> and never rewritten,
+# so each such URL always refers to the same bytes
+VIDEO_MIME_TYPES = {
+    '.mp4': 'video/mp4',
+    '.avi': 'video/x-msvideo',
+    '.mov': 'video/quicktime',
+    '.wmv': 'video/x-ms-wmv',
+    '.mkv': 'video/x-matroska'
+}
+IMMUTABLE_OUTPUT_NAME = re.compile(r'^processed_.+_([0-9a-f]{32})\.[A-Za-z0-9]+$')
+MEDIA_CHUNK_SIZE = 256 * 1024
+
+# Method names from the form mapped to WatermarkRemover methods
+METHOD_MAPPING = {
+    'inpaint': 'inpaint',
+    'blend': 'blend',
+    'mask': 'inpaint',  # Map 'mask' to 'inpaint' for backward compatibility
+    'frequency': 'frequency',
+    'exemplar': 'exemplar',
+    'temporal': 'temporal',
+    'auto': 'auto'
+}
+
+# Previews run in the request thread, so only a few may run at once
+preview_slots = threading.BoundedSemaphore(app.config['PREVIEW_CONCURRENCY'])
+
+# Streaming upload ingestion: uploaded files go straight to the upload folder, hashed and
+# checked as they arrive, instead of being spooled by Werkzeug and copied by file.save()
+UPLOAD_SNIFF_BYTES = 16
+
+def sniff_video_container(header):
+    """
+    Identify the container of a video from its first bytes
+    
+    Returns:
+    - 'mp4' (also MOV), 'avi', 'asf' (WMV) or 'matroska', or None for anything else
+    """
+    if header[4:8] in (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'):
+        return 'mp4'
+    if header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+        return 'avi'
+    if header[:16] == b'\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9\x00\xaa\x00\x62\xce\x6c':
+        return 'asf'
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return 'matroska'
+    return None
+
+class UploadStream:
+    """
+    Writable upload target that hashes and sniffs the data while writing it to disk
+    
+    Data lands in a hidden file in the upload folder; finish() renames it into place, so
+    an accepted upload is written exactly once. Data whose first bytes are not a known
+    video container is rejected with 415 as soon as those bytes arrive.
+    """
+    
+    def __init__(self, directory):
+        self.path = os.path.join(directory, f".ingest_{uuid.uuid4().hex}")
+        self.file = open(self.path, 'w+b')
+        self.digest = hashlib.sha256()
+        self.header = b''
+        self.container = None
+        self.size = 0
+        self.done = False
+    
+    def write(self, data):
+        if self.container is None:
+            self.header += data[:UPLOAD_SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= UPLOAD_SNIFF_BYTES:
+                self.container = sniff_video_container(self.header)
+                if self.container is None:
+                    self.discard()
+                    raise UnsupportedMediaType('Uploaded file is not a supported video')
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+    
+    # Werkzeug rewinds the stream once the part is complete
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+    
+    def tell(self):
+        return self.file.tell()
+    
+    def read(self, size=-1):
+        return self.file.read(size)
+    
+    def readline(self, size=-1):
+        return self.file.readline(size)
+    
+    def close(self):
+        if not self.done:
+            self.discard()
+    
+    def hexdigest(self):
+        """SHA-256 of everything written so far"""
+        return self.digest.hexdigest()
+    
+    def finish(self, file_path):
+        """
+        Move the upload to its final path
+        
+        Raises:
+        - UnsupportedMediaType if the upload was too short to be a video
+        """
+        if self.container is None:
+            self.discard()
+            raise UnsupportedMediaType('Uploaded file is not a supported video')
+        self.file.close()
+        os.replace(self.path, file_path)
+        self.done = True
+    
+    def discard(self):
+        """Drop the partial upload"""
+        self.done = True
+        if not self.file.closed:
+            self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class IngestRequest(Request):
+    """Request class that streams file uploads through UploadStream"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_streams = []
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Uploads with a disallowed extension are refused before any of their data is read
+        if filename and not allowed_file(filename):
+            raise UnsupportedMediaType('File type not allowed')
+        stream = UploadStream(app.config['UPLOAD_FOLDER'])
+        self.upload_streams.append(stream)
+        return stream
+    
+    def close(self):
+        # A truncated or aborted body leaves its stream out of request.files, so every
+        # stream opened for this request is discarded here unless it was finished
+        try:
+            super().close()
+        finally:
+            for stream in self.upload_streams:
+                stream.close()
+            self.upload_streams = []
+
+app.request_class = IngestRequest
 
 # Helper function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Helper function to read custom watermark coordinates from a form (raises ValueError)
+def form_watermark_coords(form):
+    x = int(form.get('x', 0))
+    y = int(form.get('y', 0))
+    width = int(form.get('width', 100))
+    height = int(form.get('height', 50))
+    return (x, y, width, height)
+
+# Helpers for the video metadata index
+def metadata_sidecar_path(file_path):
+    """Path of the hidden metadata sidecar of a video"""
+    directory, filename = os.path.split(file_path)
+    return os.path.join(directory, f".{filename}.json")
+
+def record_video_metadata(file_path, metadata):
+    """Store a video's metadata (as returned by probe_video) in the index and its sidecar"""
+    with video_index_lock:
+        video_index[file_path] = metadata
+    try:
+        with open(metadata_sidecar_path(file_path), 'w') as f:
+            json.dump(metadata, f)
+    except OSError as e:
+        app.logger.warning(f"Could not write metadata sidecar for {file_path}: {e}")
+
+def touch_video_metadata(file_path):
+    """Follow an mtime-only change (os.utime) of an indexed video without probing it again"""
+    with video_index_lock:
+        metadata = video_index.get(file_path)
+    if metadata is not None:
+        try:
+            metadata = dict(metadata, mtime=os.stat(file_path).st_mtime)
+        except OSError:
+            return
+        record_video_metadata(file_path, metadata)
+
+def get_video_metadata(file_path):
+    """
+    Metadata of a video from the index, probing the file only when it changed or is unknown
+    
+    Returns:
+    - Dictionary from probe_video, or None if the file does not exist
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    
+    def current(metadata):
+        return metadata is not None and metadata['size'] == file_stat.st_size and metadata['mtime'] == file_stat.st_mtime
+    
+    with video_index_lock:
+        metadata = video_index.get(file_path)
+    if current(metadata):
+        return metadata
+    
+    # Fall back to the sidecar (e.g. after a restart), then to decoding the file
+    try:
+        with open(metadata_sidecar_path(file_path)) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = None
+    if current(metadata):
+        with video_index_lock:
+            video_index[file_path] = metadata
+        return metadata
+    
+    metadata = probe_video(file_path)
+    record_video_metadata(file_path, metadata)
+    return metadata
+
+def forget_video_metadata(file_path):
+    """Drop a deleted video from the index and remove its sidecar"""
+    with video_index_lock:
+        video_index.pop(file_path, None)
+    try:
+        os.remove(metadata_sidecar_path(file_path))
+    except FileNotFoundError:
+        pass
+
 # Helper function to check if a video file is valid and accessible
 def check_video_file(file_path):
-    """Check if a video file exists, is accessible, and is valid"""
-    # Check if file exists
-    if not os.path.isfile(file_path):
+    """Check if a video file exists, is accessible, and is valid (answered from the metadata index)"""
+    metadata = get_video_metadata(file_path)
+    if metadata is None:
         return False, "File does not exist"
+    if not metadata['valid']:
+        return False, metadata['error']
+    return True, "Video file is valid"
+
+# Helpers for serving videos with conditional and range requests
+def video_mimetype(filename):
+    """MIME type of a video file by extension (mp4 if the extension is not recognized)"""
+    return VIDEO_MIME_TYPES.get(os.path.splitext(filename)[1].lower(), 'video/mp4')
+
+def media_validators(filename, metadata):
+    """
+    Strong ETag of a video and whether it can be cached forever
     
-    # Check if file is accessible
-    try:
-        with open(file_path, 'rb') as f:
-            # Just read a small portion to check access
-            f.read(1024)
-    except Exception as e:
-        return False, f"File is not accessible: {str(e)}"
+    Returns:
+    - Tuple (etag, immutable); immutable outputs are tagged by the job id in their name, which
+      stays valid when the result cache touches their mtime. run_job only moves a finished
+      output to that name, and files that fail to decode are never treated as immutable.
+    """
+    match = IMMUTABLE_OUTPUT_NAME.match(filename)
+    if match and metadata['valid']:
+        return f'"{match.group(1)}-{metadata["size"]:x}"', True
+    return f'"{metadata["size"]:x}-{int(metadata["mtime"] * 1000000):x}"', False
+
+def byte_ranges(size):
+    """
+    Satisfiable byte ranges of the request's Range header
     
-    # Check if file is a valid video
-    try:
-        cap = cv2.VideoCapture(file_path)
-        if not cap.isOpened():
-            return False, "File is not a valid video (cannot be opened)"
-        
-        # Try to read the first frame
-        ret, frame = cap.read()
-        cap.release()
-        
-        if not ret:
-            return False, "File is not a valid video (cannot read frames)"
-        
-        return True, "Video file is valid"
-    except Exception as e:
-        return False, f"Error validating video: {str(e)}"
+    Returns:
+    - List of (start, end) pairs with an exclusive end, an empty list if no range can be
+      satisfied, or None if the header is missing, malformed or asks for too many ranges
+    """
+    requested = request.range
+    if requested is None or requested.units != 'bytes' or len(requested.ranges) > app.config['MEDIA_MAX_RANGES']:
+        return None
+    
+    ranges = []
+    for start, end in requested.ranges:
+        if start < 0:  # Suffix range: the last -start bytes
+            start, end = max(size + start, 0), size
+        else:
+            end = size if end is None else min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+def if_range_matches(etag, mtime):
+    """Whether the request's If-Range validator (if any) still matches the file"""
+    validator = request.headers.get('If-Range')
+    if validator is None:
+        return True
+    if validator.startswith(('"', 'W/')):
+        # Only a strong comparison allows combining ranges from different responses
+        return validator == etag
+    date = parse_date(validator)
+    return date is not None and mtime is not None and int(date.timestamp()) == int(mtime)
+
+def iter_media_parts(file_path, parts):
+    """Yield a response body made of literal bytes and (start, end) byte ranges of a file"""
+    with open(file_path, 'rb') as f:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, end = part
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(MEDIA_CHUNK_SIZE, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+def send_media(directory, filename, metadata):
+    """
+    Serve a video with strong ETags, long-lived caching for immutable outputs, If-None-Match,
+    If-Modified-Since and If-Range handling, and single or multipart byte range responses
+    
+    With MEDIA_OFFLOAD set, the body (including ranges) is left to the front-end server via
+    X-Sendfile or X-Accel-Redirect, which sends it from the page cache without copying through Python.
+    
+    Parameters:
+    - directory: Folder holding the file
+    - filename: Name of the file inside directory
+    - metadata: Indexed metadata of the file (size and mtime are used)
+    
+    Returns:
+    - Flask response
+    """
+    file_path = os.path.join(directory, filename)
+    size = metadata['size']
+    mimetype = video_mimetype(filename)
+    etag, immutable = media_validators(filename, metadata)
+    
+    headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+    if immutable:
+        headers['Cache-Control'] = f"public, max-age={app.config['MEDIA_MAX_AGE']}, immutable"
+        mtime = None
+    else:
+        headers['Cache-Control'] = 'no-cache'
+        headers['Last-Modified'] = http_date(metadata['mtime'])
+        mtime = metadata['mtime']
+    
+    # Conditional GET: If-None-Match takes precedence over If-Modified-Since
+    if 'If-None-Match' in request.headers:
+        if request.if_none_match.contains_weak(etag.strip('"')):
+            return Response(status=304, headers=headers)
+    elif mtime is not None and request.if_modified_since is not None \
+            and int(mtime) <= int(request.if_modified_since.timestamp()):
+        return Response(status=304, headers=headers)
+    
+    offload = app.config['MEDIA_OFFLOAD']
+    if offload == 'x-sendfile':
+        headers['X-Sendfile'] = os.path.abspath(file_path)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if offload == 'x-accel':
+        headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'] + filename
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    
+    ranges = byte_ranges(size) if if_range_matches(etag, mtime) else None
+    
+    if ranges is None:
+        # Whole file through the server's file wrapper (sendfile under gunicorn and uWSGI)
+        response = send_file(file_path, mimetype=mimetype, conditional=False, etag=False, last_modified=mtime)
+        response.headers.update(headers)
+        return response
+    
+    if not ranges:
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        headers['Content-Length'] = str(end - start)
+        return Response(iter_media_parts(file_path, ranges), status=206, headers=headers, mimetype=mimetype,
+                        direct_passthrough=True)
+    
+    # multipart/byteranges: every part carries its own Content-Type and Content-Range
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, end in ranges:
+        part_header = (f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                       f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode('ascii')
+        parts += [part_header, (start, end), b"\r\n"]
+        length += len(part_header) + end - start + 2
+    closing = f"--{boundary}--\r\n".encode('ascii')
+    parts.append(closing)
+    headers['Content-Length'] = str(length + len(closing))
+    return Response(iter_media_parts(file_path, parts), status=206, headers=headers,
+                    mimetype=f"multipart/byteranges; boundary={boundary}", direct_passthrough=True)
 
 # Function to remove watermark from video (wrapper for WatermarkRemover class)
-def remove_watermark(input_path, output_path, watermark_coords=None, method='inpaint'):
+def remove_watermark(input_path, output_path, watermark_coords=None, method='inpaint', callback=None, stats=None,
+                     profiler=None):
     """
     Remove watermark from video using specified method
     
@@ -90,23 +539,16 @@ def remove_watermark(input_path, output_path, watermark_coords=None, method='inp
     - input_path: Path to input video
     - output_path: Path to save output video
     - watermark_coords: Tuple of (x, y, width, height) for watermark location
-    - method: Method to use for watermark removal ('inpaint', 'blend', 'frequency', 'exemplar', or 'auto')
+    - method: Method to use for watermark removal ('inpaint', 'blend', 'frequency', 'exemplar', 'temporal', or 'auto')
+    - callback: Optional callback function taking (progress, remaining_time), prints to stdout if None
+    - stats: Optional dictionary that process_video fills with live statistics
+    - profiler: Optional StageProfiler for per-stage timings
     """
     # Create an instance of WatermarkRemover
     remover = WatermarkRemover()
     
-    # Map method names from the form to the actual method names in the WatermarkRemover class
-    method_mapping = {
-        'inpaint': 'inpaint',
-        'blend': 'blend',
-        'mask': 'inpaint',  # Map 'mask' to 'inpaint' for backward compatibility
-        'frequency': 'frequency',
-        'exemplar': 'exemplar',
-        'auto': 'auto'
-    }
-    
     # Use the mapped method or default to 'inpaint'
-    actual_method = method_mapping.get(method, 'inpaint')
+    actual_method = METHOD_MAPPING.get(method, 'inpaint')
     
     # Define a progress callback function
     def progress_callback(progress, remaining_time):
@@ -114,29 +556,566 @@ def remove_watermark(input_path, output_path, watermark_coords=None, method='inp
         if remaining_time:
             print(f"Estimated time remaining: {remaining_time:.2f} seconds")
     
+    if callback is None:
+        callback = progress_callback
+    
+    # Long videos are split into frame ranges processed by separate processes
+    segments = 1
+    if os.path.getsize(input_path) >= app.config['SEGMENT_MIN_SIZE']:
+        segments = app.config['PROCESSING_SEGMENTS']
+    
     # Process the video
     success, message = remover.process_video(
         input_path,
         output_path,
         method=actual_method,
         watermark_coords=watermark_coords,
-        callback=progress_callback
+        callback=callback,
+        workers=app.config['PROCESSING_WORKERS'],
+        queue_size=app.config['PROCESSING_QUEUE_SIZE'],
+        segments=segments,
+        encoder=app.config['OUTPUT_ENCODER'],
+        preset=app.config['OUTPUT_PRESET'],
+        crf=app.config['OUTPUT_CRF'],
+        roi_cache=app.config['ROI_CACHE'],
+        roi_cache_tolerance=app.config['ROI_CACHE_TOLERANCE'],
+        stats=stats,
+        profiler=profiler,
+        auto_time_budget=app.config['AUTO_TIME_BUDGET'],
+        auto_min_fps=app.config['AUTO_MIN_FPS']
     )
     
     return success, message
 
+# Helper functions for operational metrics
+def count_metric(name, value=1, **labels):
+    """Add to a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + value
+
+def set_metric(name, value, **labels):
+    """Set a gauge"""
+    with metrics_lock:
+        metric_values[(name, tuple(sorted(labels.items())))] = value
+
+def observe_metric(name, value, buckets, **labels):
+    """Record one observation in a histogram"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metric_histograms.get(key)
+        if histogram is None:
+            histogram = metric_histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['counts'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def format_labels(labels):
+    """Render label pairs in the Prometheus text format"""
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def render_metrics():
+    """Current metrics in the Prometheus text exposition format"""
+    # Queue depth and cache size are read at scrape time instead of being tracked on every change
+    with jobs_lock:
+        queued = sum(1 for job in jobs.values() if job['status'] == 'queued')
+        processing = sum(1 for job in jobs.values() if job['status'] == 'processing')
+    with hls_builds_lock:
+        building = sum(1 for future in hls_builds.values() if not future.done())
+    with result_cache_lock:
+        cached = len(result_cache)
+    set_metric('watermark_jobs', queued, status='queued')
+    set_metric('watermark_jobs', processing, status='processing')
+    set_metric('watermark_hls_builds_in_progress', building)
+    set_metric('watermark_result_cache_entries', cached)
+    
+    lines = []
+    with metrics_lock:
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(metric_values.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            for (metric, labels), histogram in sorted(metric_histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+# Helper functions for background processing jobs
+def active_job_count():
+    """Number of jobs that are queued or processing (call with jobs_lock held)"""
+    return sum(1 for job in jobs.values() if job['status'] in ('queued', 'processing'))
+
+def new_job(output_filename, method):
+    """Create the bookkeeping record for a job"""
+    return {
+        'id': uuid.uuid4().hex,
+        'status': 'queued',
+        'method': method,
+        'progress': 0,
+        'eta': None,
+        'fps': None,
+        'roi_cache_hit_rate': None,
+        'auto_method': None,
+        'message': None,
+        'output_filename': output_filename,
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'profile': None,
+        # Progress event bookkeeping for /jobs/<job_id>/events
+        'version': 0,
+        'notified': 0.0,
+        'changed': threading.Condition()
+    }
+
+def submit_job(file_path, output_filename, watermark_coords, method, cache_key=None, sample=False):
+    """
+    Queue a watermark removal job on the background worker pool
+    
+    Parameters:
+    - sample: Attach a sampling profiler to this job (only honoured when JOB_SAMPLING is enabled)
+    
+    Returns:
+    - The job dictionary, or None if the pool and its queue are full
+    """
+    job = new_job(output_filename, method)
+    job_id = job['id']
+    
+    # Admission control: running jobs plus the waiting queue are bounded
+    with jobs_lock:
+        if active_job_count() >= app.config['MAX_CONCURRENT_JOBS'] + app.config['MAX_QUEUED_JOBS']:
+            return None
+        jobs[job_id] = job
+    
+    job_executor.submit(run_job, job_id, file_path, watermark_coords, method, cache_key, sample)
+    return job
+
+def completed_job(output_filename, method):
+    """Record a job that is finished right away because its result was cached"""
+    job = new_job(output_filename, method)
+    job['status'] = 'completed'
+    job['progress'] = 100
+    job['eta'] = 0
+    job['message'] = 'Watermark removal completed successfully (cached result)'
+    job['started'] = job['finished'] = job['created']
+    with jobs_lock:
+        jobs[job['id']] = job
+    count_metric('watermark_jobs_total', method=method, outcome='cached')
+    return job
+
+def notify_job(job, force=False):
+    """
+    Wake up event streams waiting on a job
+    
+    Progress updates are throttled to PROGRESS_EVENT_INTERVAL so the frame loop only
+    ever pays for a timestamp comparison; status changes are always pushed (force=True).
+    """
+    now = time.time()
+    if not force and now - job['notified'] < app.config['PROGRESS_EVENT_INTERVAL']:
+        return
+    job['notified'] = now
+    with job['changed']:
+        job['version'] += 1
+        job['changed'].notify_all()
+
+def run_job(job_id, file_path, watermark_coords, method, cache_key=None, sample=False):
+    """Process one queued job and record its outcome"""
+    job = jobs[job_id]
+    job['status'] = 'processing'
+    job['started'] = time.time()
+    notify_job(job, force=True)
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], job['output_filename'])
+    # The output only appears under its final (immutable, cacheable) name once it is complete
+    partial_path = os.path.join(app.config['OUTPUT_FOLDER'], f".partial_{job['output_filename']}")
+    stats = {}
+    
+    # Stage timings are cheap enough for every job; stack sampling is opt-in per job
+    profiler = None
+    if app.config['JOB_PROFILING']:
+        sampler = None
+        if sample and app.config['JOB_SAMPLING']:
+            sampler = SamplingProfiler(interval=app.config['JOB_SAMPLING_INTERVAL'])
+        profiler = StageProfiler(sampler=sampler)
+    
+    def progress_callback(progress, remaining_time):
+        job['progress'] = progress
+        job['eta'] = remaining_time
+        elapsed_time = time.time() - job['started']
+        if elapsed_time > 0:
+            job['fps'] = stats.get('frames', 0) / elapsed_time
+        job['roi_cache_hit_rate'] = stats.get('roi_cache_hit_rate')
+        job['auto_method'] = stats.get('auto_method')
+        notify_job(job)
+    
+    try:
+        success, message = remove_watermark(file_path, partial_path, watermark_coords, method,
+                                            callback=progress_callback, stats=stats, profiler=profiler)
+        if success:
+            os.replace(partial_path, output_path)
+    except Exception as e:
+        app.logger.error(f"Job {job_id} failed: {e}")
+        success, message = False, f"Error processing video: {str(e)}"
+    if not success:
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+    
+    if profiler is not None:
+        job['profile'] = profiler.report()
+    job['auto_method'] = stats.get('auto_method')
+    job['message'] = message
+    job['finished'] = time.time()
+    
+    frames = stats.get('frames', 0)
+    elapsed_time = job['finished'] - job['started']
+    count_metric('watermark_jobs_total', method=method, outcome='completed' if success else 'failed')
+    count_metric('watermark_frames_processed_total', frames, method=method)
+    count_metric('watermark_processing_seconds_total', elapsed_time, method=method)
+    count_metric('watermark_roi_cache_hits_total', stats.get('roi_cache_hits', 0), method=method)
+    if success and elapsed_time > 0:
+        set_metric('watermark_processing_fps', frames / elapsed_time, method=method)
+    if success:
+        if 'metadata' in stats:
+            record_video_metadata(output_path, stats['metadata'])
+        job['progress'] = 100
+        job['eta'] = 0
+        job['status'] = 'completed'
+        if cache_key:
+            store_cached_result(cache_key, job['output_filename'])
+        if app.config['HLS_EAGER']:
+            start_hls_build(output_path)
+    else:
+        job['status'] = 'failed'
+    notify_job(job, force=True)
+
+def job_status(job):
+    """JSON-serialisable view of a job"""
+    status = {key: job[key] for key in ('id', 'status', 'method', 'auto_method', 'progress', 'eta', 'fps',
+                                        'roi_cache_hit_rate', 'message')}
+    status['position'] = None
+    if job['status'] == 'queued':
+        with jobs_lock:
+            status['position'] = sum(
+                1 for other in jobs.values()
+                if other['status'] == 'queued' and other['created'] < job['created']
+            )
+    if job['status'] == 'completed':
+        status['result_url'] = url_for('result', filename=job['output_filename'])
+    if job['profile'] is not None:
+        status['profile_url'] = url_for('job_profile', job_id=job['id'])
+    return status
+
+def wants_json():
+    """Whether the client asked for a JSON response instead of a page"""
+    return request.accept_mimetypes.best == 'application/json'
+
+# Helper functions for the result cache
+def result_cache_key(content_hash, method, watermark_coords):
+    """
+    Cache key for an upload's content processed with the given settings
+    
+    Covers every setting that changes the output: the method as it runs (so 'mask' and
+    'inpaint' share entries), the coordinates, the encoder, the ROI cache tolerance and, for
+    'auto', the limits its choice depends on.
+    """
+    method = METHOD_MAPPING.get(method, 'inpaint')
+    coords = 'auto' if watermark_coords is None else ','.join(str(c) for c in watermark_coords)
+    roi_cache = str(app.config['ROI_CACHE_TOLERANCE']) if app.config['ROI_CACHE'] else 'off'
+    parts = [
+        content_hash, method, coords,
+        app.config['OUTPUT_ENCODER'], app.config['OUTPUT_PRESET'], str(app.config['OUTPUT_CRF']), roi_cache
+    ]
+    if method == 'auto':
+        parts += [str(app.config['AUTO_TIME_BUDGET']), str(app.config['AUTO_MIN_FPS'])]
+    return '|'.join(parts)
+
+def remove_cached_output(output_filename):
+    """Delete an evicted output together with its HLS directory"""
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    video_hls_dir = os.path.join(app.config['HLS_FOLDER'], os.path.splitext(output_filename)[0])
+    if os.path.isfile(output_path):
+        os.remove(output_path)
+    forget_video_metadata(output_path)
+    shutil.rmtree(video_hls_dir, ignore_errors=True)
+
+def lookup_cached_result(cache_key):
+    """
+    Find the output of an earlier identical job
+    
+    A hit refreshes the output's mtime so the 24h cleanup counts from its last use.
+    
+    Returns:
+    - Output filename, or None on a miss
+    """
+    with result_cache_lock:
+        entry = result_cache.get(cache_key)
+        if entry is None:
+            count_metric('watermark_result_cache_lookups_total', outcome='miss')
+            return None
+        
+        output_path = os.path.join(app.config['OUTPUT_FOLDER'], entry['output_filename'])
+        if not os.path.isfile(output_path):
+            # Removed by the periodic cleanup
+            del result_cache[cache_key]
+            count_metric('watermark_result_cache_lookups_total', outcome='miss')
+            return None
+        
+        entry['last_used'] = time.time()
+        result_cache.move_to_end(cache_key)
+    count_metric('watermark_result_cache_lookups_total', outcome='hit')
+    
+    os.utime(output_path)
+    touch_video_metadata(output_path)
+    video_hls_dir = os.path.join(app.config['HLS_FOLDER'], os.path.splitext(entry['output_filename'])[0])
+    if os.path.isdir(video_hls_dir):
+        os.utime(video_hls_dir)
+    return entry['output_filename']
+
+def store_cached_result(cache_key, output_filename):
+    """Add a finished job's output to the cache and evict past the size and age bounds"""
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
+    if not os.path.isfile(output_path):
+        return
+    
+    evicted = []
+    with result_cache_lock:
+        result_cache[cache_key] = {
+            'output_filename': output_filename,
+            'size': os.path.getsize(output_path),
+            'last_used': time.time()
+        }
+        result_cache.move_to_end(cache_key)
+        evicted = evict_cached_results()
+    
+    for filename in evicted:
+        remove_cached_output(filename)
+
+def evict_cached_results():
+    """
+    Drop least recently used entries past RESULT_CACHE_MAX_AGE or RESULT_CACHE_MAX_BYTES
+    (call with result_cache_lock held)
+    
+    Returns:
+    - Output filenames of the evicted entries, to be deleted outside the lock
+    """
+    evicted = []
+    current_time = time.time()
+    total_size = sum(entry['size'] for entry in result_cache.values())
+    
+    while result_cache:
+        cache_key, entry = next(iter(result_cache.items()))
+        too_old = current_time - entry['last_used'] > app.config['RESULT_CACHE_MAX_AGE']
+        # The most recent entry is always kept, however large
+        too_big = total_size > app.config['RESULT_CACHE_MAX_BYTES'] and len(result_cache) > 1
+        if not (too_old or too_big):
+            break
+        del result_cache[cache_key]
+        total_size -= entry['size']
+        evicted.append(entry['output_filename'])
+    return evicted
+
+# Helper functions for HLS packaging
+def has_audio_stream(file_path):
+    """Check with ffprobe whether a video file has an audio track"""
+    try:
+        probe = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'a',
+             '-show_entries', 'stream=index', '-of', 'csv=p=0', file_path],
+            capture_output=True, text=True, check=True
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return False
+    return bool(probe.stdout.strip())
+
+def select_hls_renditions(file_path):
+    """HLS ladder entries that fit inside the source video in both dimensions"""
+    # The resolution comes from the metadata index instead of opening the video again
+    metadata = get_video_metadata(file_path) or {}
+    source_width = metadata.get('width') or 0
+    source_height = metadata.get('height') or 0
+    
+    def fits(rendition):
+        width, height = (int(value) for value in rendition['resolution'].split('x'))
+        return width <= source_width and height <= source_height
+    
+    renditions = app.config['HLS_RENDITIONS']
+    selected = [r for r in renditions if fits(r)]
+    
+    # Sources smaller than every rung still get the smallest one
+    if not selected:
+        selected = [min(renditions, key=lambda r: int(r['resolution'].split('x')[1]))]
+    return selected
+
+def build_hls(file_path, video_hls_dir):
+    """
+    Package a video as multi-rendition HLS with a single FFmpeg run
+    
+    The source is decoded once; a split/scale filter graph feeds one encoder per
+    rendition and -var_stream_map writes every variant playlist plus master.m3u8.
+    """
+    renditions = select_hls_renditions(file_path)
+    with_audio = has_audio_stream(file_path)
+    
+    # Decode once, split the video and scale each branch to its rendition
+    outputs = ''.join(f"[v{i}]" for i in range(len(renditions)))
+    filter_graph = f"[0:v]split={len(renditions)}{outputs}"
+    for i, rendition in enumerate(renditions):
+        width, height = rendition['resolution'].split('x')
+        filter_graph += f";[v{i}]scale={width}:{height}[v{i}out]"
+    
+    ffmpeg_cmd = ['ffmpeg', '-y', '-i', file_path, '-filter_complex', filter_graph]
+    stream_map = []
+    for i, rendition in enumerate(renditions):
+        ffmpeg_cmd += ['-map', f"[v{i}out]", f"-c:v:{i}", 'libx264', f"-b:v:{i}", rendition['bitrate']]
+        if with_audio:
+            ffmpeg_cmd += ['-map', '0:a:0', f"-c:a:{i}", 'aac', f"-b:a:{i}", '128k']
+            stream_map.append(f"v:{i},a:{i},name:{rendition['name']}")
+        else:
+            stream_map.append(f"v:{i},name:{rendition['name']}")
+    
+    ffmpeg_cmd += [
+        '-preset', 'fast', '-g', '48', '-sc_threshold', '0',
+        '-f', 'hls', '-hls_time', '10', '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', os.path.join(video_hls_dir, '%v_%03d.ts'),
+        '-master_pl_name', 'master.m3u8',
+        '-var_stream_map', ' '.join(stream_map),
+        os.path.join(video_hls_dir, '%v.m3u8')
+    ]
+    
+    app.logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+    subprocess.run(ffmpeg_cmd, check=True)
+
+def start_hls_build(file_path):
+    """
+    Start packaging a video as HLS in the background unless it is ready or already building
+    
+    Returns:
+    - True if the master playlist already exists, False if a build is in flight
+    """
+    filename_base = os.path.splitext(os.path.basename(file_path))[0]
+    video_hls_dir = os.path.join(app.config['HLS_FOLDER'], filename_base)
+    if os.path.isfile(os.path.join(video_hls_dir, 'master.m3u8')):
+        return True
+    
+    # Single flight: concurrent requests share one build per video
+    with hls_builds_lock:
+        future = hls_builds.get(filename_base)
+        if future is None or future.done():
+            hls_builds[filename_base] = hls_executor.submit(run_hls_build, file_path, video_hls_dir)
+    return False
+
+def run_hls_build(file_path, video_hls_dir):
+    """
+    Build HLS content in a private directory and publish it with an atomic rename
+    
+    The build directory doubles as a marker across processes: whoever creates it owns
+    the build, and it is only taken over once it is older than HLS_BUILD_TIMEOUT.
+    """
+    filename_base = os.path.basename(video_hls_dir)
+    building_dir = f"{video_hls_dir}.building"
+    failed = False
+    try:
+        try:
+            os.mkdir(building_dir)
+        except FileExistsError:
+            if time.time() - os.path.getmtime(building_dir) < app.config['HLS_BUILD_TIMEOUT']:
+                app.logger.info(f"HLS build for {filename_base} is running in another process")
+                return
+            app.logger.warning(f"Taking over abandoned HLS build for {filename_base}")
+            shutil.rmtree(building_dir, ignore_errors=True)
+            os.mkdir(building_dir)
+        
+        build_start = time.time()
+        try:
+            app.logger.info(f"Generating HLS segments for {filename_base}")
+            build_hls(file_path, building_dir)
+            observe_metric('watermark_hls_build_seconds', time.time() - build_start, HLS_BUILD_BUCKETS, outcome='success')
+            
+            # The source may have been evicted or cleaned up while FFmpeg was running
+            if not os.path.isfile(file_path):
+                shutil.rmtree(building_dir, ignore_errors=True)
+                return
+            
+            # Playlists and segments appear all at once; leftovers of a partial build are replaced
+            if os.path.isdir(video_hls_dir):
+                shutil.rmtree(video_hls_dir)
+            os.rename(building_dir, video_hls_dir)
+            app.logger.info(f"HLS conversion complete for {filename_base}")
+        except Exception as e:
+            app.logger.error(f"Error generating HLS content: {e}")
+            observe_metric('watermark_hls_build_seconds', time.time() - build_start, HLS_BUILD_BUCKETS, outcome='error')
+            shutil.rmtree(building_dir, ignore_errors=True)
+            raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        # Every outcome but a failure releases the entry; a failed build stays until
+        # hls_master has reported its error
+        if not failed:
+            with hls_builds_lock:
+                hls_builds.pop(filename_base, None)
+
+@app.after_request
+def count_bytes_served(response):
+    """Count response body bytes per route (streamed responses without a length are skipped)"""
+    if request.method != 'HEAD' and response.content_length:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        count_metric('watermark_bytes_served_total', response.content_length, route=route)
+    return response
+
 # Routes
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for jobs, processing speed, queues, HLS builds, traffic and caches"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template('index.html', now=datetime.now())
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    if 'video' not in request.files:
+    # Reject early when the worker pool and its queue are already full, before reading the body
+    with jobs_lock:
+        saturated = active_job_count() >= app.config['MAX_CONCURRENT_JOBS'] + app.config['MAX_QUEUED_JOBS']
+    if saturated:
+        count_metric('watermark_jobs_total', method='unknown', outcome='rejected')
+        if wants_json():
+            return jsonify({'error': 'Server is busy, please try again later'}), 503, {'Retry-After': '30'}
+        flash('Server is busy, please try again in a few minutes')
+        return redirect(url_for('index'))
+    
+    # Parsing the form streams the file to disk; anything that is not a video stops it early
+    try:
+        files = request.files
+    except UnsupportedMediaType as e:
+        if wants_json():
+            return jsonify({'error': e.description}), 415
+        flash(e.description)
+        return redirect(url_for('index'))
+    
+    if 'video' not in files:
         flash('No video file part')
         return redirect(request.url)
     
-    file = request.files['video']
+    file = files['video']
     
     if file.filename == '':
         flash('No selected file')
@@ -148,12 +1127,19 @@ def upload_file():
         filename_base, file_extension = os.path.splitext(original_filename)
         unique_filename = f"{filename_base}_{uuid.uuid4().hex}{file_extension}"
         
-        # Save the uploaded file
+        # The upload is already on disk, it only needs its final name
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+        try:
+            file.stream.finish(file_path)
+        except UnsupportedMediaType as e:
+            if wants_json():
+                return jsonify({'error': e.description}), 415
+            flash(e.description)
+            return redirect(url_for('index'))
         
-        # Get watermark removal method and coordinates
-        method = request.form.get('method', 'inpaint')
+        # Get watermark removal method and coordinates; unknown names run (and are labelled) as inpaint,
+        # so client input cannot create new metric series
+        method = METHOD_MAPPING.get(request.form.get('method', 'inpaint'), 'inpaint')
         
         # Check if custom coordinates are provided
         use_custom_coords = 'use_custom_coords' in request.form
@@ -161,11 +1147,7 @@ def upload_file():
         
         if use_custom_coords:
             try:
-                x = int(request.form.get('x', 0))
-                y = int(request.form.get('y', 0))
-                width = int(request.form.get('width', 100))
-                height = int(request.form.get('height', 50))
-                watermark_coords = (x, y, width, height)
+                watermark_coords = form_watermark_coords(request.form)
             except ValueError:
                 flash('Invalid coordinate values. Using default coordinates.')
         
@@ -175,22 +1157,198 @@ def upload_file():
             # Auto-detection will be handled by the WatermarkRemover class
             watermark_coords = None
         
+        # Reuse the output of an identical earlier upload
+        cache_key = result_cache_key(file.stream.hexdigest(), method, watermark_coords)
+        cached_filename = lookup_cached_result(cache_key)
+        if cached_filename:
+            os.remove(file_path)
+            job = completed_job(cached_filename, method)
+            if app.config['HLS_EAGER']:
+                start_hls_build(os.path.join(app.config['OUTPUT_FOLDER'], cached_filename))
+            if wants_json():
+                return jsonify({
+                    'job_id': job['id'],
+                    'status_url': url_for('job_status_api', job_id=job['id']),
+                    'result_url': url_for('result', filename=cached_filename)
+                }), 200
+            return redirect(url_for('result', filename=cached_filename))
+        
         # Generate output filename
         output_filename = f"processed_{unique_filename}"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
         
-        # Process the video (remove watermark)
-        success, message = remove_watermark(file_path, output_path, watermark_coords, method)
+        # Queue the video for processing and return right away
+        sample = request.values.get('profile') == '1'
+        job = submit_job(file_path, output_filename, watermark_coords, method, cache_key, sample)
         
-        if success:
-            return redirect(url_for('result', filename=output_filename))
-        else:
-            flash(message)
+        if job is None:
+            os.remove(file_path)
+            count_metric('watermark_jobs_total', method=method, outcome='rejected')
+            if wants_json():
+                return jsonify({'error': 'Server is busy, please try again later'}), 503, {'Retry-After': '30'}
+            flash('Server is busy, please try again in a few minutes')
             return redirect(url_for('index'))
+        
+        if wants_json():
+            return jsonify({
+                'job_id': job['id'],
+                'status_url': url_for('job_status_api', job_id=job['id'])
+            }), 202
+        return redirect(url_for('processing', job_id=job['id']))
     
     flash('File type not allowed')
     return redirect(url_for('index'))
 
+@app.route('/preview', methods=['POST'])
+def preview():
+    """
+    Before/after thumbnails of one or more methods on a few sampled frames, without starting a job
+    
+    Takes the same form fields as /upload, plus 'methods' (comma-separated, defaults to 'method'),
+    'samples', 'max_width' and 'crop' (pixels around the watermark box to show instead of whole frames).
+    Images are returned as JPEG data URIs and the upload is discarded afterwards.
+    """
+    if not preview_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many previews running, please try again shortly'}), 503, {'Retry-After': '5'}
+    
+    preview_path = None
+    try:
+        try:
+            files = request.files
+        except UnsupportedMediaType as e:
+            return jsonify({'error': e.description}), 415
+        
+        file = files.get('video')
+        if file is None or file.filename == '':
+            return jsonify({'error': 'No video file'}), 400
+        
+        requested = request.form.get('methods') or request.form.get('method', 'inpaint')
+        methods = []
+        for name in requested.split(','):
+            name = name.strip()
+            if name not in METHOD_MAPPING:
+                return jsonify({'error': f"Unknown method: {name}"}), 400
+            # 'auto' is previewed as every method it chooses from
+            candidates = WatermarkRemover.AUTO_METHODS if name == 'auto' else (METHOD_MAPPING[name],)
+            for method in candidates:
+                if method not in methods:
+                    methods.append(method)
+        
+        try:
+            watermark_coords = None
+            if 'use_custom_coords' in request.form and 'use_auto_detect' not in request.form:
+                watermark_coords = form_watermark_coords(request.form)
+            samples = min(max(int(request.form.get('samples', app.config['PREVIEW_SAMPLES'])), 1),
+                          app.config['PREVIEW_MAX_SAMPLES'])
+            max_width = min(int(request.form.get('max_width', app.config['PREVIEW_MAX_WIDTH'])),
+                            app.config['PREVIEW_MAX_WIDTH'])
+            crop_margin = int(request.form['crop']) if request.form.get('crop') else None
+        except ValueError:
+            return jsonify({'error': 'Invalid numeric field'}), 400
+        if max_width < 1:
+            return jsonify({'error': 'max_width must be at least 1'}), 400
+        if crop_margin is not None and crop_margin < 0:
+            return jsonify({'error': 'crop must be a margin of 0 or more pixels'}), 400
+        
+        # The upload only needs to live for this request
+        file_extension = os.path.splitext(secure_filename(file.filename))[1]
+        preview_path = os.path.join(app.config['UPLOAD_FOLDER'], f".preview_{uuid.uuid4().hex}{file_extension}")
+        try:
+            file.stream.finish(preview_path)
+        except UnsupportedMediaType as e:
+            preview_path = None
+            return jsonify({'error': e.description}), 415
+        
+        result = WatermarkRemover().preview(preview_path, methods=methods, watermark_coords=watermark_coords,
+                                            samples=samples, max_width=max_width, crop_margin=crop_margin)
+        if result is None:
+            return jsonify({'error': 'Could not read frames from the video'}), 422
+        
+        def data_uri(image):
+            _, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+            return 'data:image/jpeg;base64,' + base64.b64encode(encoded.tobytes()).decode('ascii')
+        
+        fps = result['fps']
+        return jsonify({
+            'methods': methods,
+            'watermark_coords': list(result['watermark_coords']),
+            'scale': result['scale'],
+            'decode_ms': round(1000 * result['decode_seconds'], 1),
+            'ms_per_frame': result['timings'],
+            'frames': [{
+                'index': frame['index'],
+                'time': round(frame['index'] / fps, 3) if fps else None,
+                'before': data_uri(frame['before']),
+                'after': {method: data_uri(image) for method, image in frame['after'].items()}
+            } for frame in result['frames']]
+        })
+    finally:
+        if preview_path is not None and os.path.exists(preview_path):
+            os.remove(preview_path)
+        preview_slots.release()
+
+@app.route('/jobs/<job_id>')
+def job_status_api(job_id):
+    """Report the status, progress and ETA of a processing job"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/profile')
+def job_profile(job_id):
+    """Per-stage timings, latency histograms and (if sampled) hot functions of a finished job"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['profile'] is None:
+        return jsonify({'error': 'No profile recorded for this job'}), 404
+    return jsonify({'job_id': job['id'], 'status': job['status'], 'method': job['method'], **job['profile']})
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream job progress as Server-Sent Events until the job finishes"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        version = None
+        while True:
+            # Sleep until the job reports something new (or send a keep-alive)
+            with job['changed']:
+                changed = job['changed'].wait_for(
+                    lambda: job['version'] != version,
+                    timeout=app.config['PROGRESS_KEEPALIVE']
+                )
+                version = job['version']
+            
+            if not changed:
+                yield ": keep-alive\n\n"
+                continue
+            
+            status = job_status(job)
+            yield f"event: {'progress' if status['status'] in ('queued', 'processing') else status['status']}\n"
+            yield f"data: {json.dumps(status)}\n\n"
+            if status['status'] in ('completed', 'failed'):
+                return
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Ask reverse proxies not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/processing/<job_id>')
+def processing(job_id):
+    """Progress page shown while a job is queued or processing"""
+    job = jobs.get(job_id)
+    if job is None:
+        flash('Processing job not found')
+        return redirect(url_for('index'))
+    if job['status'] == 'completed':
+        return redirect(url_for('result', filename=job['output_filename']))
+    return render_template('processing.html', job=job_status(job), now=datetime.now())
+
 @app.route('/result/<filename>')
 def result(filename):
     # Check if the file exists and is valid
@@ -222,58 +1380,31 @@ def video(filename):
     # Check if the file exists and is valid
     file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
     
-    if not os.path.isfile(file_path):
+    # One stat call validates the indexed size and mtime
+    metadata = get_video_metadata(file_path)
+    if metadata is None:
         app.logger.error(f"File not found: {file_path}")
         return "File not found", 404
+    if not metadata['valid']:
+        app.logger.error(f"Video file issue: {metadata['error']}")
+        return f"Video file issue: {metadata['error']}", 404
     
-    # Get file size for logging
-    file_size = os.path.getsize(file_path)
-    app.logger.info(f"Serving video file: {file_path}, Size: {file_size} bytes")
-        
-    # Get the file extension to determine the correct MIME type
-    file_extension = os.path.splitext(filename)[1].lower()
-    mime_types = {
-        '.mp4': 'video/mp4',
-        '.avi': 'video/x-msvideo',
-        '.mov': 'video/quicktime',
-        '.wmv': 'video/x-ms-wmv',
-        '.mkv': 'video/x-matroska'
-    }
-    # Default to mp4 if extension not recognized
-    mimetype = mime_types.get(file_extension, 'video/mp4')
-    app.logger.info(f"Using MIME type: {mimetype} for file extension: {file_extension}")
+    file_size = metadata['size']
+    
+    # Headers are only formatted for a sample of requests, and only when debug logging is on
+    log_request = app.logger.isEnabledFor(logging.DEBUG) and \
+        next(video_log_counter) % app.config['VIDEO_LOG_SAMPLE_EVERY'] == 0
+    if log_request:
+        app.logger.debug(f"Serving video file: {file_path}, Size: {file_size} bytes")
     
     try:
-        # Log request headers for debugging
-        app.logger.info(f"Request headers: {request.headers}")
+        if log_request:
+            app.logger.debug(f"Using MIME type: {video_mimetype(filename)}, request headers: {request.headers}")
         
-        # Generate ETag based on file modification time and size
-        file_mtime = os.path.getmtime(file_path)
-        etag = f"\"{file_mtime}-{file_size}\"" 
+        response = send_media(app.config['OUTPUT_FOLDER'], filename, metadata)
         
-        # Check if client sent If-None-Match header
-        if request.headers.get('If-None-Match') == etag:
-            return '', 304  # Not Modified
-        
-        # Use send_from_directory instead of send_file
-        response = send_from_directory(
-            app.config['OUTPUT_FOLDER'],
-            filename,
-            mimetype=mimetype,
-            as_attachment=False
-        )
-        
-        # Add headers to prevent caching issues
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        # Add Accept-Ranges header to support seeking
-        response.headers['Accept-Ranges'] = 'bytes'
-        # Add ETag for conditional requests
-        response.headers['ETag'] = etag
-        
-        # Log response headers for debugging
-        app.logger.info(f"Response headers: {response.headers}")
+        if log_request:
+            app.logger.debug(f"Response headers: {response.headers}")
         
         return response
     except Exception as e:
@@ -297,25 +1428,16 @@ def direct_video(filename):
     """A simpler route for serving video files directly"""
     file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
     
-    if not os.path.isfile(file_path):
+    metadata = get_video_metadata(file_path)
+    if metadata is None:
         app.logger.error(f"File not found: {file_path}")
         return "File not found", 404
-    
-    # Get the file extension to determine the correct MIME type
-    file_extension = os.path.splitext(filename)[1].lower()
-    mime_types = {
-        '.mp4': 'video/mp4',
-        '.avi': 'video/x-msvideo',
-        '.mov': 'video/quicktime',
-        '.wmv': 'video/x-ms-wmv',
-        '.mkv': 'video/x-matroska'
-    }
-    # Default to mp4 if extension not recognized
-    mimetype = mime_types.get(file_extension, 'video/mp4')
+    if not metadata['valid']:
+        app.logger.error(f"Video file issue: {metadata['error']}")
+        return f"Video file issue: {metadata['error']}", 404
     
     try:
-        # Use a very simple approach with send_file
-        return send_file(file_path, mimetype=mimetype)
+        return send_media(app.config['OUTPUT_FOLDER'], filename, metadata)
     except Exception as e:
         app.logger.error(f"Error serving video file: {e}")
         return f"Error: {str(e)}", 500
@@ -349,61 +1471,20 @@ def hls_master(filename):
     filename_base = os.path.splitext(os.path.basename(file_path))[0]
     app.logger.info(f"HLS request for {filename}, using file: {file_path}, base: {filename_base}")
     
-    # Create HLS directory for this video if it doesn't exist
     video_hls_dir = os.path.join(app.config['HLS_FOLDER'], filename_base)
-    os.makedirs(video_hls_dir, exist_ok=True)
     
-    # Check if master playlist already exists
-    master_playlist_path = os.path.join(video_hls_dir, 'master.m3u8')
+    # Report a failed background build once, then allow the next request to retry it
+    with hls_builds_lock:
+        future = hls_builds.get(filename_base)
+        if future is not None and future.done() and future.exception() is not None:
+            del hls_builds[filename_base]
+            return f"Error generating HLS content: {str(future.exception())}", 500
     
-    if not os.path.isfile(master_playlist_path):
-        # Generate HLS segments and playlists using FFmpeg
-        try:
-            app.logger.info(f"Generating HLS segments for {filename_base}")
-            
-            # Define quality levels (resolution, bitrate)
-            qualities = [
-                {'name': '720p', 'resolution': '1280x720', 'bitrate': '2000k'},
-                {'name': '480p', 'resolution': '854x480', 'bitrate': '1000k'},
-                {'name': '360p', 'resolution': '640x360', 'bitrate': '500k'}
-            ]
-            
-            # Create master playlist content
-            master_content = "#EXTM3U\n#EXT-X-VERSION:3\n"
-            
-            for quality in qualities:
-                # Add each quality variant to the master playlist
-                master_content += f"#EXT-X-STREAM-INF:BANDWIDTH={quality['bitrate'].replace('k', '000')},RESOLUTION={quality['resolution']}\n"
-                master_content += f"{quality['name']}.m3u8\n"
-                
-                # Generate HLS segments for this quality
-                variant_output = os.path.join(video_hls_dir, f"{quality['name']}.m3u8")
-                segment_pattern = os.path.join(video_hls_dir, f"{quality['name']}_%03d.ts")
-                
-                ffmpeg_cmd = [
-                    'ffmpeg', '-y', '-i', file_path,
-                    '-c:v', 'libx264', '-c:a', 'aac',
-                    '-b:v', quality['bitrate'], '-b:a', '128k',
-                    '-vf', f"scale={quality['resolution'].split('x')[0]}:{quality['resolution'].split('x')[1]}",
-                    '-preset', 'fast', '-g', '48', '-sc_threshold', '0',
-                    '-hls_time', '10', '-hls_playlist_type', 'vod',
-                    '-hls_segment_filename', segment_pattern,
-                    variant_output
-                ]
-                
-                app.logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
-                subprocess.run(ffmpeg_cmd, check=True)
-                app.logger.info(f"Generated HLS variant: {quality['name']}")
-            
-            # Write master playlist
-            with open(master_playlist_path, 'w') as f:
-                f.write(master_content)
-                
-            app.logger.info(f"HLS conversion complete for {filename_base}")
-            
-        except Exception as e:
-            app.logger.error(f"Error generating HLS content: {e}")
-            return f"Error generating HLS content: {str(e)}", 500
+    # Playlists are built in the background; ask the client to come back while that runs
+    if not start_hls_build(file_path):
+        response = Response("HLS content is being generated", status=202, mimetype='text/plain')
+        response.headers['Retry-After'] = str(app.config['HLS_RETRY_AFTER'])
+        return response
     
     # Serve the master playlist
     return send_from_directory(video_hls_dir, 'master.m3u8', mimetype='application/vnd.apple.mpegurl')
@@ -451,12 +1532,29 @@ def cleanup_old_files():
             file_path = os.path.join(OUTPUT_FOLDER, filename)
             if os.path.isfile(file_path) and (current_time - os.path.getmtime(file_path)) > cleanup_time:
                 os.remove(file_path)
+                with video_index_lock:
+                    video_index.pop(file_path, None)
                 
         # Clean HLS segments folder
         for dirname in os.listdir(HLS_FOLDER):
             dir_path = os.path.join(HLS_FOLDER, dirname)
             if os.path.isdir(dir_path) and (current_time - os.path.getmtime(dir_path)) > cleanup_time:
                 shutil.rmtree(dir_path)
+        
+        # Forget cached results whose files are gone or that have not been used for too long
+        with result_cache_lock:
+            for cache_key in [cache_key for cache_key, entry in result_cache.items()
+                              if not os.path.isfile(os.path.join(OUTPUT_FOLDER, entry['output_filename']))]:
+                del result_cache[cache_key]
+            evicted = evict_cached_results()
+        for filename in evicted:
+            remove_cached_output(filename)
+        
+        # Forget finished jobs
+        with jobs_lock:
+            for job_id in [job_id for job_id, job in jobs.items()
+                           if job['finished'] and (current_time - job['finished']) > cleanup_time]:
+                del jobs[job_id]
 
 if __name__ == '__main__':
     app.run(debug=True)
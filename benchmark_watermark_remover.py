@@ -0,0 +1,292 @@
+"""
+Benchmark WatermarkRemover and the Flask pipeline on synthetic clips
+
+Every measurement runs in a fresh process so its peak RSS is its own. Results are
+written as JSON; pass an earlier result file as --baseline to flag throughput regressions.
+
+Example:
+    python benchmark_watermark_remover.py --resolutions 640x360,1280x720 --durations 2 --output bench.json
+    python benchmark_watermark_remover.py --baseline bench.json --tolerance 0.15
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from watermark_remover import WatermarkRemover, create_mask
+from test_watermark_remover import create_test_video
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METHODS = ['inpaint', 'blend', 'frequency', 'exemplar', 'temporal']
+# process_video options recorded with each end-to-end result; results only compare with equal options
+PROCESS_VIDEO_OPTIONS = ('workers', 'batch_size', 'encoder')
+
+
+def peak_rss_mb():
+    """Peak resident set size of the current process in MB, or None where it cannot be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def watermark_box(width, height):
+    """Box around the text watermark drawn by create_test_video"""
+    text_width, text_height = cv2.getTextSize("TEST WATERMARK", cv2.FONT_HERSHEY_SIMPLEX, 1, 2)[0]
+    return (width - text_width - 15, height - text_height - 15, text_width + 10, text_height + 10)
+
+
+def run_isolated(function, *args):
+    """Run a benchmark function in a new process and return its result"""
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(function, *args).result()
+
+
+def bench_method(video_path, method, watermark_coords, max_frames):
+    """
+    Time one remove_watermark_* method on frames decoded up front
+    
+    Returns:
+    - Dictionary with frames, seconds, fps, ms_per_frame and peak RSS before and after processing
+    """
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    
+    height, width = frames[0].shape[:2]
+    mask = create_mask(width, height, watermark_coords)
+    remover = WatermarkRemover()
+    remove = getattr(remover, f'remove_watermark_{method}')
+    decoded_rss = peak_rss_mb()
+    
+    start = time.perf_counter()
+    for frame in frames:
+        remove(frame, mask, roi=watermark_coords)
+    seconds = time.perf_counter() - start
+    
+    return {
+        'frames': len(frames),
+        'seconds': round(seconds, 4),
+        'fps': round(len(frames) / seconds, 2),
+        'ms_per_frame': round(1000.0 * seconds / len(frames), 3),
+        'decoded_rss_mb': decoded_rss,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def bench_process_video(video_path, output_path, method, watermark_coords, options):
+    """
+    Time a full process_video run (decode, removal and encode)
+    
+    Returns:
+    - Dictionary with success, message, frames, seconds, fps and peak RSS
+    """
+    stats = {}
+    start = time.perf_counter()
+    success, message = WatermarkRemover().process_video(
+        video_path, output_path, method=method, watermark_coords=watermark_coords, stats=stats, **options
+    )
+    seconds = time.perf_counter() - start
+    frames = stats.get('frames', 0)
+    
+    return {
+        'success': success,
+        'message': message,
+        'frames': frames,
+        'seconds': round(seconds, 4),
+        'fps': round(frames / seconds, 2) if seconds > 0 else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def bench_hls_master(video_path, work_dir, timeout):
+    """
+    Time how long /hls/<name>/master.m3u8 takes to go from the first request to a playlist
+    
+    The processed clip is copied into a private output folder and the route is polled
+    through the Flask test client, so this covers the background build and the 202 responses.
+    
+    Returns:
+    - Dictionary with status, seconds, renditions and peak RSS
+    """
+    import app as webapp
+    
+    output_folder = os.path.join(work_dir, 'outputs')
+    hls_folder = os.path.join(work_dir, 'hls_segments')
+    os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(hls_folder, exist_ok=True)
+    webapp.app.config['OUTPUT_FOLDER'] = output_folder
+    webapp.app.config['HLS_FOLDER'] = hls_folder
+    shutil.copy(video_path, os.path.join(output_folder, 'processed_benchmark.mp4'))
+    
+    client = webapp.app.test_client()
+    start = time.perf_counter()
+    while True:
+        response = client.get('/hls/processed_benchmark/master.m3u8')
+        seconds = time.perf_counter() - start
+        if response.status_code != 202 or seconds > timeout:
+            break
+        time.sleep(0.05)
+    
+    playlist = response.get_data(as_text=True) if response.status_code == 200 else ''
+    return {
+        'status': response.status_code,
+        'seconds': round(seconds, 4),
+        'renditions': playlist.count('#EXT-X-STREAM-INF'),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find benchmarks that got slower than the baseline by more than the tolerance
+    
+    Throughput (fps) must not drop and HLS packaging time must not grow by more than the tolerance.
+    Results are matched on benchmark, clip, method and the process_video options, so a baseline
+    run with other --workers, --batch-size or --encoder values is not compared.
+    
+    Returns:
+    - List of human-readable regression descriptions
+    """
+    def key(result):
+        options = tuple(result.get(option) for option in PROCESS_VIDEO_OPTIONS)
+        return (result['benchmark'], result['clip'], result.get('method')) + options
+    
+    previous = {key(r): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        name = '/'.join(str(part) for part in (result['benchmark'], result['clip'], result.get('method')) if part)
+        if result.get('fps') and before.get('fps') and result['fps'] < before['fps'] * (1 - tolerance):
+            regressions.append(f"{name}: {before['fps']} -> {result['fps']} fps")
+        elif result['benchmark'] == 'hls_master' and result.get('status') == 200 and before.get('status') == 200 \
+                and result['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append(f"{name}: {before['seconds']} -> {result['seconds']} s")
+    return regressions
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--resolutions', default='640x360,1280x720,1920x1080',
+                        help='Comma-separated WIDTHxHEIGHT list of clip sizes')
+    parser.add_argument('--durations', default='2,5', help='Comma-separated clip durations in seconds')
+    parser.add_argument('--fps', type=int, default=30, help='Frame rate of the synthetic clips')
+    parser.add_argument('--methods', default=','.join(METHODS), help='Comma-separated removal methods')
+    parser.add_argument('--method-frames', type=int, default=60, help='Frames timed per method benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='process_video worker threads')
+    parser.add_argument('--batch-size', type=int, default=1, help='process_video batch size')
+    parser.add_argument('--encoder', default='opencv', choices=['opencv', 'ffmpeg'], help='process_video output encoder')
+    parser.add_argument('--skip-video', action='store_true', help='Skip the end-to-end process_video benchmarks')
+    parser.add_argument('--skip-hls', action='store_true', help='Skip the hls_master packaging benchmark')
+    parser.add_argument('--hls-timeout', type=float, default=600, help='Seconds to wait for an HLS playlist')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative slowdown against the baseline')
+    args = parser.parse_args()
+    
+    resolutions = [parse_resolution(value) for value in args.resolutions.split(',')]
+    durations = [float(value) for value in args.durations.split(',')]
+    methods = [method for method in args.methods.split(',') if method]
+    options = {'workers': args.workers, 'batch_size': args.batch_size, 'encoder': args.encoder}
+    
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'platform': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'system': platform.system(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'ffmpeg': shutil.which('ffmpeg') is not None
+        },
+        'settings': vars(args),
+        'clips': [],
+        'results': []
+    }
+    
+    work_dir = tempfile.mkdtemp(prefix='watermark_benchmark_')
+    try:
+        for width, height in resolutions:
+            for duration in durations:
+                clip = f"{width}x{height}_{duration:g}s"
+                clip_path = os.path.join(work_dir, f'{clip}.mp4')
+                coords = watermark_box(width, height)
+                
+                # Synthetic clip with a text watermark in the bottom right corner
+                start = time.perf_counter()
+                create_test_video(clip_path, width, height, duration=duration, fps=args.fps)
+                report['clips'].append({
+                    'clip': clip, 'width': width, 'height': height, 'duration': duration, 'fps': args.fps,
+                    'watermark_coords': coords, 'generate_seconds': round(time.perf_counter() - start, 4)
+                })
+                
+                for method in methods:
+                    print(f"{clip} {method}: methods", file=sys.stderr)
+                    result = run_isolated(bench_method, clip_path, method, coords, args.method_frames)
+                    report['results'].append({'benchmark': 'method', 'clip': clip, 'method': method, **result})
+                    
+                    if args.skip_video:
+                        continue
+                    print(f"{clip} {method}: process_video", file=sys.stderr)
+                    output_path = os.path.join(work_dir, f'{clip}_{method}.mp4')
+                    result = run_isolated(bench_process_video, clip_path, output_path, method, coords, options)
+                    report['results'].append({'benchmark': 'process_video', 'clip': clip, 'method': method,
+                                              **options, **result})
+                
+                if args.skip_hls:
+                    continue
+                if shutil.which('ffmpeg') is None:
+                    report['results'].append({'benchmark': 'hls_master', 'clip': clip, 'skipped': 'ffmpeg not found'})
+                    continue
+                print(f"{clip}: hls_master", file=sys.stderr)
+                hls_dir = os.path.join(work_dir, f'{clip}_hls')
+                result = run_isolated(bench_hls_master, clip_path, hls_dir, args.hls_timeout)
+                report['results'].append({'benchmark': 'hls_master', 'clip': clip, **result})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f), args.tolerance)
+        report['baseline'] = args.baseline
+        report['regressions'] = regressions
+    
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+    
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -40,7 +40,7 @@ class HLSManager {
             
             // Check if HLS is supported
             if (this.isSupported) {
-                this.initHLS();
+                this.waitForPlaylist();
             } else if (this.video.canPlayType('application/vnd.apple.mpegurl')) {
                 // For Safari - native HLS support
                 console.log('Using native HLS support');
@@ -54,6 +54,31 @@ class HLSManager {
         }
     }
     
+    waitForPlaylist() {
+        // The server answers 202 with Retry-After while the playlists are still being built;
+        // the original source keeps playing in the meantime
+        fetch(this.hlsUrl, { method: 'HEAD' })
+            .then(response => {
+                if (response.status === 202) {
+                    const retryAfter = parseInt(response.headers.get('Retry-After'), 10) || 5;
+                    console.log(`HLS: Playlist is being generated, retrying in ${retryAfter}s`);
+                    setTimeout(() => this.waitForPlaylist(), retryAfter * 1000);
+                } else if (response.ok) {
+                    // Don't interrupt playback that already started on the original source
+                    if (this.video.paused && this.video.currentTime === 0) {
+                        this.initHLS();
+                    } else {
+                        console.log('HLS: Playlist ready, keeping the original source during playback');
+                    }
+                } else {
+                    console.warn('HLS: Playlist unavailable, keeping the original source');
+                }
+            })
+            .catch(e => {
+                console.warn('HLS: Could not check playlist status:', e);
+            });
+    }
+    
     initHLS() {
         // Destroy any existing instance
         this.destroyHLS();
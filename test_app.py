@@ -0,0 +1,105 @@
+import os
+from app import app
+from test_watermark_remover import create_test_video
+
+def media_client():
+    """
+    Test client serving a short test clip from the test directory as an output video
+    
+    Returns:
+    - (client, filename, file contents)
+    """
+    test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test')
+    os.makedirs(test_dir, exist_ok=True)
+    filename = 'test_video_media.mp4'
+    video_path = os.path.join(test_dir, filename)
+    if not os.path.exists(video_path):
+        create_test_video(video_path, duration=1, with_watermark=False)
+    with open(video_path, 'rb') as f:
+        data = f.read()
+    
+    app.config['TESTING'] = True
+    app.config['OUTPUT_FOLDER'] = test_dir
+    app.config['MEDIA_OFFLOAD'] = ''
+    return app.test_client(), filename, data
+
+def test_video_ranges():
+    """
+    /video must answer single, suffix, unsatisfiable and multipart byte ranges as RFC 9110 describes
+    """
+    output_folder = app.config['OUTPUT_FOLDER']
+    try:
+        client, filename, data = media_client()
+        size = len(data)
+        url = f'/video/{filename}'
+        
+        # Single range
+        response = client.get(url, headers={'Range': 'bytes=100-199'})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes 100-199/{size}'
+        assert response.headers['Content-Length'] == '100'
+        assert response.data == data[100:200]
+        
+        # Suffix range: the last 50 bytes
+        response = client.get(url, headers={'Range': 'bytes=-50'})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes {size - 50}-{size - 1}/{size}'
+        assert response.data == data[-50:]
+        
+        # Range starting past the end of the file
+        response = client.get(url, headers={'Range': f'bytes={size + 10}-'})
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == f'bytes */{size}'
+        
+        # Multipart: the announced length must match the bytes sent, and each part the file
+        response = client.get(url, headers={'Range': 'bytes=0-9,200-299'})
+        assert response.status_code == 206
+        assert response.mimetype == 'multipart/byteranges'
+        body = response.get_data()
+        assert int(response.headers['Content-Length']) == len(body)
+        boundary = response.mimetype_params['boundary'].encode('ascii')
+        parts = body.split(b'--' + boundary)
+        assert parts[-1] == b'--\r\n'
+        payloads = [part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts[1:-1]]
+        assert payloads == [data[0:10], data[200:300]]
+    finally:
+        app.config['OUTPUT_FOLDER'] = output_folder
+    
+    print("Video range test passed")
+
+def test_video_conditional_requests():
+    """
+    A stale If-Range must get the whole file, and a matching If-None-Match a 304
+    """
+    output_folder = app.config['OUTPUT_FOLDER']
+    try:
+        client, filename, data = media_client()
+        url = f'/video/{filename}'
+        
+        etag = client.get(url).headers['ETag']
+        
+        # A validator from another version of the file turns the range request into a full response
+        response = client.get(url, headers={'Range': 'bytes=0-99', 'If-Range': '"stale"'})
+        assert response.status_code == 200
+        assert response.data == data
+        
+        # The current validator still gets the range
+        response = client.get(url, headers={'Range': 'bytes=0-99', 'If-Range': etag})
+        assert response.status_code == 206
+        assert response.data == data[:100]
+        
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert response.data == b''
+        
+        response = client.get(url, headers={'If-None-Match': '"stale"'})
+        assert response.status_code == 200
+    finally:
+        app.config['OUTPUT_FOLDER'] = output_folder
+    
+    print("Video conditional request test passed")
+
+if __name__ == "__main__":
+    test_video_ranges()
+    test_video_conditional_requests()
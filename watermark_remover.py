@@ -1,42 +1,416 @@
 import cv2
 import numpy as np
-from scipy import ndimage
 import os
+import queue
+import bisect
+import collections
+import contextlib
+import itertools
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 
-class WatermarkRemover:
+def create_mask(width, height, watermark_coords):
     """
-    A class for removing watermarks from videos using various techniques.
+    Create a binary mask for a rectangular watermark region
+    
+    Parameters:
+    - width: Frame width
+    - height: Frame height
+    - watermark_coords: Tuple of (x, y, width, height) for watermark location
+    
+    Returns:
+    - Mask with 255 inside the watermark region and 0 elsewhere
+    """
+    x, y, w, h = watermark_coords
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[y:y+h, x:x+w] = 255
+    return mask
+
+
+class FFmpegVideoWriter:
+    """
+    Video writer that pipes raw BGR frames into an FFmpeg subprocess for H.264 encoding.
+    Mirrors the parts of the cv2.VideoWriter interface used by WatermarkRemover.
     """
     
-    def __init__(self):
-        """Initialize the WatermarkRemover class"""
-        pass
+    def __init__(self, output_path, fps, size, preset='veryfast', crf=23, audio_path=None):
+        """
+        Start the FFmpeg encoder
+        
+        Parameters:
+        - output_path: Path to save output video file
+        - fps: Frame rate of the output
+        - size: (width, height) of the frames that will be written
+        - preset: x264 speed/compression preset
+        - crf: x264 constant rate factor (lower is higher quality)
+        - audio_path: Optional file whose first audio track is copied into the output without re-encoding
+        """
+        width, height = size
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{width}x{height}", '-r', str(fps), '-i', '-'
+        ]
+        if audio_path:
+            cmd += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'copy']
+        cmd += [
+            # yuv420p needs even dimensions
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart', output_path
+        ]
+        
+        # Errors go to a file so a chatty encoder can never block on a full pipe
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self.stderr)
+        self.error = None
     
-    def detect_watermark(self, frames, num_frames=10):
+    def isOpened(self):
+        """Whether the encoder is still accepting frames"""
+        return self.process.poll() is None
+    
+    def write(self, frame):
         """
-        Attempt to automatically detect the watermark location by analyzing multiple frames
+        Send one frame to the encoder
         
         Parameters:
-        - frames: List of video frames
-        - num_frames: Number of frames to analyze
+        - frame: BGR frame of the size given to the constructor
+        """
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            self.release()
+            raise RuntimeError(f"FFmpeg encoder stopped: {self.error}") from None
+    
+    def release(self):
+        """Finish encoding and wait for FFmpeg to exit; sets error if it failed"""
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        if self.process.wait() != 0 and self.error is None:
+            self.stderr.seek(0)
+            self.error = self.stderr.read().decode(errors='replace').strip() or f"exit code {self.process.returncode}"
+        self.stderr.close()
+
+
+def open_video_writer(output_path, fps, size, encoder='opencv', preset='veryfast', crf=23, audio_path=None):
+    """
+    Open an output video writer
+    
+    Parameters:
+    - output_path: Path to save output video file
+    - fps: Frame rate of the output
+    - size: (width, height) of the output
+    - encoder: 'ffmpeg' for H.264 through an FFmpeg pipe, 'opencv' for cv2.VideoWriter with mp4v
+    - preset: x264 preset (ffmpeg encoder only)
+    - crf: x264 constant rate factor (ffmpeg encoder only)
+    - audio_path: File whose audio track is copied into the output (ffmpeg encoder only)
+    
+    Returns:
+    - FFmpegVideoWriter or cv2.VideoWriter; falls back to OpenCV when FFmpeg is not installed
+    """
+    if encoder == 'ffmpeg' and shutil.which('ffmpeg'):
+        return FFmpegVideoWriter(output_path, fps, size, preset=preset, crf=crf, audio_path=audio_path)
+    return cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+
+
+def probe_video(video_path):
+    """
+    Read a video's metadata and check that its first frame decodes
+    
+    Parameters:
+    - video_path: Path to the video file
+    
+    Returns:
+    - Dictionary with valid, error, width, height, fps, frame_count, duration, codec (FourCC),
+      size (bytes) and mtime; the video properties are None when the file cannot be opened
+    """
+    metadata = {
+        'valid': False, 'error': None, 'width': None, 'height': None, 'fps': None,
+        'frame_count': None, 'duration': None, 'codec': None, 'size': None, 'mtime': None
+    }
+    try:
+        stat = os.stat(video_path)
+    except OSError as e:
+        metadata['error'] = f"File is not accessible: {e}"
+        return metadata
+    metadata['size'] = stat.st_size
+    metadata['mtime'] = stat.st_mtime
+    
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            metadata['error'] = "File is not a valid video (cannot be opened)"
+            return metadata
+        
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        metadata.update({
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': fps,
+            'frame_count': frame_count,
+            'duration': frame_count / fps if fps > 0 else None,
+            'codec': ''.join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip('\x00 ') or None
+        })
         
+        ret, _ = cap.read()
+        if not ret:
+            metadata['error'] = "File is not a valid video (cannot read frames)"
+            return metadata
+    finally:
+        cap.release()
+    
+    metadata['valid'] = True
+    return metadata
+
+
+def structural_similarity(image, reference):
+    """
+    Mean SSIM of two images on their grayscale versions (11x11 Gaussian window, sigma 1.5)
+    
+    Parameters:
+    - image: BGR or grayscale image
+    - reference: Image of the same size to compare against
+    
+    Returns:
+    - SSIM between -1 and 1 (1 for identical images)
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if reference.ndim == 3:
+        reference = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+    a = image.astype(np.float64)
+    b = reference.astype(np.float64)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    
+    def blur(values):
+        return cv2.GaussianBlur(values, (11, 11), 1.5)
+    
+    mean_a, mean_b = blur(a), blur(b)
+    var_a = blur(a * a) - mean_a * mean_a
+    var_b = blur(b * b) - mean_b * mean_b
+    covariance = blur(a * b) - mean_a * mean_b
+    ssim_map = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / \
+        ((mean_a * mean_a + mean_b * mean_b + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+class QualityMeter:
+    """
+    Accumulates PSNR and SSIM of frames against a clean reference over the watermark box,
+    where the removal methods differ; the rest of the frame is left untouched by all of them.
+    """
+    
+    def __init__(self, frame_shape, roi):
+        """
+        Parameters:
+        - frame_shape: (height, width) of the frames
+        - roi: Tuple of (x, y, width, height) for the watermark box
+        """
+        rows, cols = frame_shape[:2]
+        x, y, w, h = roi
+        self.box = (slice(max(0, y), min(rows, y + h)), slice(max(0, x), min(cols, x + w)))
+        self.squared_error = 0.0
+        self.values = 0
+        self.ssim_total = 0.0
+        self.count = 0
+    
+    def update(self, frame, reference):
+        """Add one frame and its clean reference"""
+        crop = frame[self.box]
+        reference_crop = reference[self.box]
+        if crop.size == 0:
+            return
+        diff = crop.astype(np.float64) - reference_crop
+        self.squared_error += float(np.square(diff).sum())
+        self.values += diff.size
+        self.ssim_total += structural_similarity(crop, reference_crop)
+        self.count += 1
+    
+    def report(self):
+        """
         Returns:
-        - (x, y, width, height): Coordinates of detected watermark or None if not detected
+        - Dictionary with psnr (dB over all frames, inf for identical boxes) and mean ssim, or None without frames
         """
-        if len(frames) < num_frames:
-            num_frames = len(frames)
+        if self.count == 0:
+            return None
+        mse = self.squared_error / self.values
+        psnr = 10 * np.log10(255.0 ** 2 / mse) if mse > 0 else float('inf')
+        return {'psnr': round(float(psnr), 3), 'ssim': round(self.ssim_total / self.count, 4)}
+
+
+class RoiCache:
+    """
+    Remembers the last patched watermark box together with the pixels around it, so
+    frames whose watermark neighbourhood did not change can reuse that result.
+    """
+    
+    def __init__(self, frame_shape, roi, margin=16, tolerance=0):
+        """
+        Initialize an empty cache
         
-        # Sample frames at regular intervals
-        step = len(frames) // num_frames
-        sample_frames = [frames[i * step] for i in range(num_frames)]
+        Parameters:
+        - frame_shape: Shape of the video frames
+        - roi: Tuple of (x, y, width, height) for the watermark box
+        - margin: Border around the box that must also be unchanged (at least the removal method's margin)
+        - tolerance: Largest per-pixel difference still treated as unchanged
+        """
+        rows, cols = frame_shape[:2]
+        x, y, w, h = roi
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(cols, x + w), min(rows, y + h)
+        self.box = (slice(y0, y1), slice(x0, x1))
+        self.region = (slice(max(0, y0 - margin), min(rows, y1 + margin)),
+                       slice(max(0, x0 - margin), min(cols, x1 + margin)))
+        self.tolerance = tolerance
+        self.reference = None
+        self.patched = None
+        self.lookups = 0
+        self.hits = 0
+    
+    def matches(self, frame):
+        """
+        Check whether a frame's watermark neighbourhood equals the one of the cached result
         
-        # Convert frames to grayscale
-        gray_frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in sample_frames]
+        On a miss the frame becomes the new reference, and its patched result must be
+        handed to store() before the next hit is applied.
         
-        # Calculate the standard deviation of each pixel across frames
-        stacked = np.stack(gray_frames)
-        std_dev = np.std(stacked, axis=0)
+        Parameters:
+        - frame: Input video frame, before processing
+        
+        Returns:
+        - True if the cached result can be reused for this frame
+        """
+        self.lookups += 1
+        region = frame[self.region]
+        if self.reference is not None and cv2.norm(region, self.reference, cv2.NORM_INF) <= self.tolerance:
+            self.hits += 1
+            return True
+        self.reference = region.copy()
+        return False
+    
+    def store(self, processed_frame):
+        """Remember the patched box of the frame that missed last"""
+        self.patched = processed_frame[self.box].copy()
+    
+    def apply(self, frame):
+        """Copy the cached patched box into a frame (in place) and return it"""
+        frame[self.box] = self.patched
+        return frame
+    
+    def hit_rate(self):
+        """Fraction of lookups that reused the cached result"""
+        return self.hits / self.lookups if self.lookups else 0.0
+
+
+def read_frames(cap):
+    """
+    Yield the remaining frames of an opened video capture
+    
+    Parameters:
+    - cap: Opened cv2.VideoCapture
+    
+    Yields:
+    - Decoded BGR frames in order
+    """
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            return
+        yield frame
+
+
+def read_frame_batches(cap, batch_size, leading=()):
+    """
+    Yield the remaining frames of an opened video capture in batches
+    
+    Frames are decoded straight into one preallocated (batch_size, height, width, 3) buffer,
+    so each yielded batch is a view that is overwritten by the next one.
+    
+    Parameters:
+    - cap: Opened cv2.VideoCapture
+    - batch_size: Number of frames per batch
+    - leading: Already decoded frames to yield before the ones still in the capture
+    
+    Yields:
+    - Arrays of shape (n, height, width, 3) with n <= batch_size, in frame order
+    """
+    leading = iter(leading)
+    buffer = None
+    while True:
+        count = 0
+        while buffer is None or count < batch_size:
+            frame = next(leading, None)
+            if frame is None:
+                slot = buffer[count] if buffer is not None else None
+                ret, frame = cap.read(slot)
+                if not ret:
+                    break
+            if buffer is None:
+                # Size the buffer from the first decoded frame
+                buffer = np.empty((batch_size,) + frame.shape, dtype=frame.dtype)
+            if not np.shares_memory(frame, buffer[count]):
+                buffer[count] = frame
+            count += 1
+        if count == 0:
+            return
+        yield buffer[:count]
+        if count < batch_size:
+            return
+
+
+class StreamingWatermarkDetector:
+    """
+    Accumulates per-pixel grayscale mean and variance over sampled frames (Welford's
+    algorithm) so a static watermark can be located with one frame's worth of memory.
+    """
+    
+    def __init__(self):
+        """Initialize an empty detector"""
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+    
+    def update(self, frame):
+        """
+        Add one BGR frame to the running statistics
+        
+        Parameters:
+        - frame: Video frame
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY).astype(np.float64)
+        if self.mean is None:
+            self.mean = np.zeros_like(gray)
+            self.m2 = np.zeros_like(gray)
+        
+        self.count += 1
+        delta = gray - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (gray - self.mean)
+    
+    def detect(self):
+        """
+        Locate the watermark from the frames seen so far
+        
+        Returns:
+        - (x, y, width, height): Coordinates of detected watermark or None if not detected
+        """
+        if self.count == 0:
+            return None
+        
+        # Standard deviation of each pixel across frames
+        std_dev = np.sqrt(self.m2 / self.count)
         
         # Threshold the standard deviation to find static areas
         _, thresh = cv2.threshold(std_dev.astype(np.uint8), 5, 255, cv2.THRESH_BINARY_INV)
@@ -52,7 +426,7 @@ class WatermarkRemover:
         x, y, w, h = cv2.boundingRect(largest_contour)
         
         # Validate the detected region (basic checks)
-        frame_height, frame_width = gray_frames[0].shape
+        frame_height, frame_width = std_dev.shape
         min_size = min(frame_width, frame_height) * 0.01  # Minimum 1% of frame dimension
         max_size = min(frame_width, frame_height) * 0.3   # Maximum 30% of frame dimension
         
@@ -60,145 +434,1657 @@ class WatermarkRemover:
             return None
         
         return (x, y, w, h)
+
+
+class StageProfiler:
+    """
+    Cumulative per-stage timers and latency histograms for process_video
+    
+    Stages are timed with time.perf_counter() around calls process_video makes anyway, so
+    the cost is two clock reads and a lock per stage and frame. An optional sampler (any
+    object with start() and stop(), such as SamplingProfiler) runs for the whole job.
+    """
+    
+    # Upper edges of the latency histogram buckets in milliseconds; the last bucket is open-ended
+    BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+    
+    def __init__(self, sampler=None, enabled=True):
+        """
+        Parameters:
+        - sampler: Optional sampling profiler started and stopped with the job
+        - enabled: False turns every call into a no-op
+        """
+        self.sampler = sampler if enabled else None
+        self.enabled = enabled
+        self.stages = {}
+        self.wall_seconds = 0.0
+        self._started = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Start the wall clock and the sampler"""
+        self._started = time.perf_counter()
+        if self.sampler is not None:
+            self.sampler.start()
+    
+    def stop(self):
+        """Stop the wall clock and the sampler"""
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self._started is not None:
+            self.wall_seconds += time.perf_counter() - self._started
+            self._started = None
+    
+    def register_thread(self):
+        """Let the sampler follow the calling thread (used by pipeline threads)"""
+        if self.sampler is not None and hasattr(self.sampler, 'add_thread'):
+            self.sampler.add_thread(threading.get_ident())
+    
+    def add(self, stage, seconds):
+        """
+        Record one timed call of a stage
+        
+        Parameters:
+        - stage: Stage name ('seek', 'sample', 'detect', 'read', 'method', 'write', ...)
+        - seconds: Duration of the call
+        """
+        if not self.enabled:
+            return
+        bucket = bisect.bisect_left(self.BUCKETS_MS, seconds * 1000.0)
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = {
+                    'seconds': 0.0, 'count': 0, 'max': 0.0, 'histogram': [0] * (len(self.BUCKETS_MS) + 1)
+                }
+            entry['seconds'] += seconds
+            entry['count'] += 1
+            entry['max'] = max(entry['max'], seconds)
+            entry['histogram'][bucket] += 1
+    
+    def merge(self, stages):
+        """Add the raw stage entries of another profiler (e.g. from a segment worker process)"""
+        with self._lock:
+            for stage, other in stages.items():
+                entry = self.stages.get(stage)
+                if entry is None:
+                    self.stages[stage] = {key: list(value) if key == 'histogram' else value
+                                          for key, value in other.items()}
+                    continue
+                entry['seconds'] += other['seconds']
+                entry['count'] += other['count']
+                entry['max'] = max(entry['max'], other['max'])
+                entry['histogram'] = [a + b for a, b in zip(entry['histogram'], other['histogram'])]
+    
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """Context manager timing the enclosed block as one call of a stage"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+    
+    def timed(self, items, stage='read'):
+        """Wrap an iterator so producing each item is timed as one call of a stage"""
+        if not self.enabled:
+            yield from items
+            return
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield item
+    
+    def report(self):
+        """
+        Summarise the recorded timings
+        
+        Returns:
+        - JSON-serialisable dictionary with the wall time, the histogram bucket edges, one entry per
+          stage (total seconds, calls, mean and max milliseconds, histogram counts) and the
+          sampler's report if it has one
+        """
+        with self._lock:
+            stages = {
+                stage: {
+                    'seconds': round(entry['seconds'], 6),
+                    'count': entry['count'],
+                    'mean_ms': round(1000.0 * entry['seconds'] / entry['count'], 4) if entry['count'] else 0.0,
+                    'max_ms': round(1000.0 * entry['max'], 4),
+                    'histogram': list(entry['histogram'])
+                }
+                for stage, entry in self.stages.items()
+            }
+        report = {
+            'wall_seconds': round(self.wall_seconds, 6),
+            'buckets_ms': list(self.BUCKETS_MS),
+            'stages': stages
+        }
+        if self.sampler is not None and hasattr(self.sampler, 'report'):
+            report['sampler'] = self.sampler.report()
+        return report
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for a single job: a background thread records the Python stack of
+    the threads it follows at a fixed interval, so its cost does not grow with the number
+    of calls the profiled code makes. It follows the thread that starts it and any thread
+    added with add_thread().
+    """
+    
+    def __init__(self, interval=0.005, top=25):
+        """
+        Parameters:
+        - interval: Seconds between samples
+        - top: Number of functions listed in the report
+        """
+        self.interval = interval
+        self.top = top
+        self.samples = 0
+        self.leaf = collections.Counter()
+        self.inclusive = collections.Counter()
+        self._threads = set()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def add_thread(self, thread_id):
+        """Also sample the thread with the given identifier"""
+        self._threads.add(thread_id)
+    
+    def start(self):
+        """Start sampling the calling thread"""
+        self.add_thread(threading.get_ident())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop sampling"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self._threads):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                self.samples += 1
+                self.leaf[self._describe(frame.f_code)] += 1
+                seen = set()
+                while frame is not None:
+                    seen.add(self._describe(frame.f_code))
+                    frame = frame.f_back
+                self.inclusive.update(seen)
+    
+    @staticmethod
+    def _describe(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
     
-    def remove_watermark_inpaint(self, frame, mask):
+    def report(self):
+        """
+        Returns:
+        - Dictionary with the sample count and the functions seen most often, both as the
+          running function ('self') and anywhere on the stack ('total'), with their share of samples
+        """
+        def ranked(counter):
+            return [
+                {'function': name, 'samples': count, 'percent': round(100.0 * count / self.samples, 2)}
+                for name, count in counter.most_common(self.top)
+            ]
+        
+        return {
+            'interval': self.interval,
+            'samples': self.samples,
+            'self': ranked(self.leaf),
+            'total': ranked(self.inclusive)
+        }
+
+
+# Worker processes for segment runs, shared by every process_video call so that concurrent
+# jobs queue their frame ranges instead of multiplying the number of processes
+_segment_pool = None
+_segment_pool_size = os.cpu_count() or 1
+_segment_pool_lock = threading.Lock()
+
+
+def configure_segment_pool(max_processes):
+    """
+    Set how many worker processes all segment runs share
+    
+    Parameters:
+    - max_processes: Upper limit on segment processes across all jobs; a running pool is
+      replaced once its current work is done
+    """
+    global _segment_pool, _segment_pool_size
+    with _segment_pool_lock:
+        _segment_pool_size = max(1, int(max_processes))
+        if _segment_pool is not None:
+            _segment_pool.shutdown(wait=False)
+            _segment_pool = None
+
+
+def segment_pool():
+    """
+    Process pool shared by all segment runs, created on first use
+    
+    Workers start with forkserver (spawn where it is unavailable) rather than fork: forking
+    from a threaded server copies locks held by other threads, which can deadlock the child.
+    """
+    global _segment_pool
+    with _segment_pool_lock:
+        if _segment_pool is None:
+            start_methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+            _segment_pool = ProcessPoolExecutor(max_workers=_segment_pool_size, mp_context=context)
+        return _segment_pool
+
+
+def _discard_segment_pool(pool):
+    """Drop a broken pool so the next segment run starts a new one"""
+    global _segment_pool
+    with _segment_pool_lock:
+        if _segment_pool is pool:
+            _segment_pool = None
+    pool.shutdown(wait=False)
+
+
+def _process_segment(input_path, part_path, method, watermark_coords, fps, size, start, count, encoding,
+                     roi_cache_tolerance=None, profile=False):
+    """
+    Remove the watermark from one frame range in a worker process
+    
+    Parameters:
+    - input_path: Path to input video file
+    - part_path: Path to save this range's output
+    - method: Watermark removal method
+    - watermark_coords: Tuple of (x, y, width, height) for watermark location
+    - fps: Frame rate of the output
+    - size: (width, height) of the output
+    - start: Index of the first frame in the range
+    - count: Number of frames in the range, or None to read to the end of the video
+    - encoding: Keyword arguments for open_video_writer (audio is added when the parts are joined)
+    - roi_cache_tolerance: Reuse the previous result when the watermark neighbourhood changed by at most
+      this much (None to process every frame)
+    - profile: Time the seek, read, method and write stages
+    
+    Returns:
+    - (frames written, frames served from the ROI cache, raw StageProfiler stages to merge)
+    """
+    profiler = StageProfiler(enabled=profile)
+    remover = WatermarkRemover()
+    mask = create_mask(size[0], size[1], watermark_coords)
+    roi_cache = None
+    if roi_cache_tolerance is not None:
+        roi_cache = RoiCache((size[1], size[0]), watermark_coords, margin=remover.roi_margin(method),
+                             tolerance=roi_cache_tolerance)
+    
+    # The capture and writer are released even if processing fails, so no encoder process outlives the range
+    cap = cv2.VideoCapture(input_path)
+    out = None
+    try:
+        if start > 0:
+            with profiler.measure('seek'):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+                if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+                    # The backend's seek is not frame-accurate here; decode forward from the first frame
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    for _ in range(start):
+                        if not cap.grab():
+                            break
+            position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+            if position != start:
+                raise RuntimeError(f"Could not seek to frame {start} of the segment (landed on {position})")
+        out = open_video_writer(part_path, fps, size, **encoding)
+        
+        frame_number = 0
+        while count is None or frame_number < count:
+            with profiler.measure('read'):
+                ret, frame = cap.read()
+            if not ret:
+                break
+            if roi_cache is not None and roi_cache.matches(frame):
+                processed_frame = roi_cache.apply(frame)
+            else:
+                with profiler.measure('method'):
+                    processed_frame = remover._remove_watermark_frame(frame, mask, method, watermark_coords)
+                if roi_cache is not None:
+                    roi_cache.store(processed_frame)
+            with profiler.measure('write'):
+                out.write(processed_frame)
+            frame_number += 1
+    finally:
+        cap.release()
+        if out is not None:
+            out.release()
+    
+    if getattr(out, 'error', None):
+        raise RuntimeError(f"Could not encode segment: {out.error}")
+    if count is not None and frame_number != count:
+        # A short range would drop frames at the seam when the parts are joined
+        raise RuntimeError(f"Segment starting at frame {start} read {frame_number} of {count} frames")
+    return frame_number, roi_cache.hits if roi_cache is not None else 0, profiler.stages
+
+
+class WatermarkRemover:
+    """
+    A class for removing watermarks from videos using various techniques.
+    """
+    
+    # Methods 'auto' chooses from, best quality first (SSIM over the watermark box of the test clip);
+    # temporal is left out because its quality depends on the footage and it runs on one thread
+    AUTO_METHODS = ('exemplar', 'inpaint', 'blend')
+    # Frames each candidate is timed on
+    AUTO_SAMPLE_FRAMES = 3
+    # Memory the detect_in_pass window may buffer; it holds whole decoded frames
+    DETECT_WINDOW_BYTES = 128 * 1024 * 1024
+    # Pixels around the watermark box each method reads with its default parameters (the
+    # margin it passes to _process_roi); the ROI cache must watch at least this border
+    METHOD_MARGINS = {'inpaint': 7, 'blend': 12, 'frequency': 16, 'exemplar': 32, 'temporal': 8}
+    
+    def __init__(self):
+        """Initialize the WatermarkRemover class"""
+        # High-pass filters for remove_watermark_frequency, keyed by (rows, cols, radius, frame_rows, frame_cols)
+        self._frequency_filters = {}
+        # Background plate carried between frames by remove_watermark_temporal
+        self._temporal_state = None
+        # Nearest-neighbour field carried between frames by remove_watermark_exemplar
+        self._exemplar_field = None
+        # Blend weights for the last mask seen and per-thread blur buffers for remove_watermark_blend
+        self._blend_weights_cache = None
+        self._buffers = threading.local()
+    
+    def detect_watermark(self, frames, num_frames=10):
+        """
+        Attempt to automatically detect the watermark location by analyzing multiple frames
+        
+        Parameters:
+        - frames: List of video frames
+        - num_frames: Number of frames to analyze
+        
+        Returns:
+        - (x, y, width, height): Coordinates of detected watermark or None if not detected
+        """
+        if len(frames) < num_frames:
+            num_frames = len(frames)
+        
+        # Sample frames at regular intervals
+        step = len(frames) // num_frames
+        sample_frames = [frames[i * step] for i in range(num_frames)]
+        
+        # Accumulate per-pixel statistics one frame at a time
+        detector = StreamingWatermarkDetector()
+        for frame in sample_frames:
+            detector.update(frame)
+        
+        return detector.detect()
+    
+    def detect_watermark_stream(self, cap, frame_count, max_samples=30, profiler=None, samples=None, max_grab=16):
+        """
+        Detect the watermark in a single forward pass over the video
+        
+        grab() still decodes, so only short gaps between samples are skipped with it (saving
+        the colour conversion of retrieving them); longer gaps are skipped with a seek. Only
+        running statistics are kept.
+        
+        Parameters:
+        - cap: Opened cv2.VideoCapture positioned at the first frame
+        - frame_count: Total number of frames in the video
+        - max_samples: Maximum number of frames to analyze
+        - profiler: Optional StageProfiler; skipping and decoding count as 'sample', the statistics as 'detect'
+        - samples: Optional list that receives AUTO_SAMPLE_FRAMES of the analyzed frames, spread over the video
+        - max_grab: Longest gap between samples that is skipped with grab() instead of a seek
+        
+        Returns:
+        - (x, y, width, height): Coordinates of detected watermark or None if not detected
+        """
+        if profiler is None:
+            profiler = StageProfiler(enabled=False)
+        max_samples = min(max_samples, frame_count)
+        step = max(1, frame_count // max(1, max_samples))
+        keep_step = max(1, max_samples // self.AUTO_SAMPLE_FRAMES)
+        detector = StreamingWatermarkDetector()
+        position = 0
+        
+        for index in range(0, frame_count, step):
+            if detector.count >= max_samples:
+                break
+            with profiler.measure('sample'):
+                if index - position > max_grab:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                    position = index
+                while position < index and cap.grab():
+                    position += 1
+                ret, frame = cap.read() if position == index else (False, None)
+            position += 1
+            if not ret:
+                break
+            with profiler.measure('detect'):
+                detector.update(frame)
+            if samples is not None and len(samples) < self.AUTO_SAMPLE_FRAMES and (detector.count - 1) % keep_step == 0:
+                samples.append(frame)
+        
+        with profiler.measure('detect'):
+            return detector.detect()
+    
+    def _process_roi(self, frame, mask, roi, margin, fill):
+        """
+        Run a removal function on the watermark box plus a margin and write the result back
+        
+        Parameters:
+        - frame: Input video frame (modified in place)
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Tuple of (x, y, width, height) for the watermark box, or None to derive it from the mask
+        - margin: Number of border pixels the removal function needs around the box
+        - fill: Function taking (crop, mask_crop) and returning the patched crop
+        
+        Returns:
+        - The input frame with the watermark region patched
+        """
+        if roi is None:
+            roi = cv2.boundingRect(mask)
+        
+        # Clip the watermark box to the frame
+        rows, cols = frame.shape[:2]
+        x, y, w, h = roi
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(cols, x + w), min(rows, y + h)
+        if x1 <= x0 or y1 <= y0:
+            return frame
+        
+        # Grow the box by the margin the method needs (crop is a view into the frame)
+        x0, y0 = max(0, x0 - margin), max(0, y0 - margin)
+        x1, y1 = min(cols, x1 + margin), min(rows, y1 + margin)
+        crop = frame[y0:y1, x0:x1]
+        mask_crop = mask[y0:y1, x0:x1]
+        
+        # Only pixels under the mask are replaced, the margin is left untouched
+        patched = fill(crop, mask_crop)
+        np.copyto(crop, patched, where=(mask_crop > 0)[:, :, np.newaxis])
+        return frame
+    
+    def remove_watermark_inpaint(self, frame, mask, roi=None, radius=3):
         """
         Remove watermark using inpainting technique
         
         Parameters:
-        - frame: Input video frame
+        - frame: Input video frame (patched in place)
         - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Optional (x, y, width, height) of the watermark box, derived from the mask if None
+        - radius: Inpainting neighbourhood radius
         
         Returns:
         - Processed frame with watermark removed
         """
-        # Apply inpainting
-        result = cv2.inpaint(frame, mask, 3, cv2.INPAINT_TELEA)
-        return result
+        # Apply inpainting on the watermark box plus enough context for the neighbourhood
+        def fill(crop, mask_crop):
+            return cv2.inpaint(crop, mask_crop, radius, cv2.INPAINT_TELEA)
+        
+        return self._process_roi(frame, mask, roi, 2 * radius + 1, fill)
+    
+    def _blend_weights(self, mask_crop):
+        """
+        Get float32 blend weights for a mask crop, computed once per mask
+        
+        Parameters:
+        - mask_crop: Mask over the processed crop (255 for watermark, 0 elsewhere)
+        
+        Returns:
+        - (original weights, blur weights), or None if the mask is binary
+        """
+        cached = self._blend_weights_cache
+        if cached is not None and cached[0].shape == mask_crop.shape and np.array_equal(cached[0], mask_crop):
+            return cached[1]
+        
+        weights = None
+        if np.count_nonzero((mask_crop > 0) & (mask_crop < 255)):
+            # Create a normalized mask (0-1 range)
+            norm_mask = mask_crop.astype(np.float32) / 255.0
+            weights = (1.0 - norm_mask, norm_mask)
+        self._blend_weights_cache = (mask_crop.copy(), weights)
+        return weights
     
-    def remove_watermark_blend(self, frame, mask, kernel_size=25):
+    def remove_watermark_blend(self, frame, mask, kernel_size=25, roi=None):
         """
         Remove watermark by blending with surrounding pixels
         
         Parameters:
-        - frame: Input video frame
-        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - frame: Input video frame (patched in place)
+        - mask: Mask where watermark is located (255 for watermark, 0 elsewhere, values in between blend)
         - kernel_size: Size of the Gaussian blur kernel
+        - roi: Optional (x, y, width, height) of the watermark box, derived from the mask if None
         
         Returns:
         - Processed frame with watermark removed
         """
-        # Create a blurred version of the frame
-        blur = cv2.GaussianBlur(frame, (kernel_size, kernel_size), 0)
+        def fill(crop, mask_crop):
+            # Blur into a buffer reused across frames (one per thread for pipelined processing)
+            blur = getattr(self._buffers, 'blur', None)
+            if blur is None or blur.shape != crop.shape:
+                blur = np.empty_like(crop)
+                self._buffers.blur = blur
+            cv2.GaussianBlur(crop, (kernel_size, kernel_size), 0, dst=blur)
+            
+            # With a binary mask the blend is the blurred crop itself (only masked pixels are written back)
+            weights = self._blend_weights(mask_crop)
+            if weights is None:
+                return blur
+            
+            # Blend the original crop and the blurred crop using the mask
+            return cv2.blendLinear(crop, blur, weights[0], weights[1])
+        
+        # The blur needs half a kernel of context around the box
+        return self._process_roi(frame, mask, roi, kernel_size // 2, fill)
+    
+    def _frequency_filter(self, rows, cols, radius, frame_rows=None, frame_cols=None):
+        """
+        Get the high-pass filter for an rfft2 spectrum, building it on first use
+        
+        Parameters:
+        - rows: Number of rows of the transformed image
+        - cols: Number of columns of the transformed image
+        - radius: Radius of the removed low-frequency disc, in frequency indices of the full frame
+        - frame_rows: Number of rows of the frame the image was cropped from (rows if None)
+        - frame_cols: Number of columns of the frame the image was cropped from (cols if None)
         
-        # Create a normalized mask (0-1 range)
-        norm_mask = mask.astype(float) / 255.0
-        norm_mask = np.expand_dims(norm_mask, axis=2)  # Add channel dimension
-        norm_mask = np.repeat(norm_mask, 3, axis=2)    # Repeat for each color channel
+        Frequency indices are scaled per axis to the full frame, so a crop keeps the same
+        spatial cutoff (periods below frame_rows / radius and frame_cols / radius pixels)
+        as filtering the whole frame would.
         
-        # Blend the original frame and the blurred frame using the mask
-        result = (1 - norm_mask) * frame + norm_mask * blur
-        return result.astype(np.uint8)
+        Returns:
+        - Float array of shape (rows, cols // 2 + 1), 1 for frequencies to keep and 0 for frequencies to remove
+        """
+        frame_rows = rows if frame_rows is None else frame_rows
+        frame_cols = cols if frame_cols is None else frame_cols
+        key = (rows, cols, radius, frame_rows, frame_cols)
+        mask_fft = self._frequency_filters.get(key)
+        if mask_fft is None:
+            # Frequencies measured from the DC term at [0, 0], as rfft2 lays them out,
+            # in cycles per frame height and width
+            u = np.fft.fftfreq(rows, 1.0 / rows)[:, np.newaxis] * (frame_rows / rows)
+            v = np.fft.rfftfreq(cols, 1.0 / cols)[np.newaxis, :] * (frame_cols / cols)
+            mask_fft = (u ** 2 + v ** 2 > radius * radius).astype(np.float64)
+            self._frequency_filters[key] = mask_fft
+        return mask_fft
     
-    def remove_watermark_frequency(self, frame, mask):
+    def remove_watermark_frequency(self, frame, mask, roi=None, margin=16, radius=30):
         """
         Remove watermark using frequency domain filtering
         
         Parameters:
-        - frame: Input video frame
+        - frame: Input video frame (patched in place)
         - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Optional (x, y, width, height) of the watermark box, derived from the mask if None
+        - margin: Border around the box included in the transform to soften wrap-around artefacts
+        - radius: Radius of the low-frequency disc removed by the filter
         
         Returns:
         - Processed frame with watermark removed
         """
-        # Process each channel separately
-        result = np.zeros_like(frame)
+        frame_rows, frame_cols = frame.shape[:2]
         
-        for c in range(3):  # For each color channel
-            # Get the current channel
-            channel = frame[:, :, c]
+        def fill(crop, mask_crop):
+            rows, cols = crop.shape[:2]
+            
+            # Apply a real-input FFT to all three channels in one call
+            f_transform = np.fft.rfft2(crop, axes=(0, 1))
             
-            # Apply FFT
-            f_transform = np.fft.fft2(channel)
-            f_shift = np.fft.fftshift(f_transform)
+            # Apply the cached high-pass filter (laid out for the unshifted spectrum), with the
+            # cutoff of the full frame
+            f_transform *= self._frequency_filter(rows, cols, radius, frame_rows, frame_cols)[:, :, np.newaxis]
             
-            # Create a high-pass filter (to remove the watermark frequencies)
-            rows, cols = channel.shape
-            crow, ccol = rows // 2, cols // 2
+            # Inverse FFT
+            img_back = np.abs(np.fft.irfft2(f_transform, s=(rows, cols), axes=(0, 1)))
             
-            # Create a mask for the filter (1 for frequencies to keep, 0 for frequencies to remove)
-            mask_fft = np.ones((rows, cols), np.uint8)
-            r = 30  # Filter radius
-            center = [crow, ccol]
-            x, y = np.ogrid[:rows, :cols]
-            mask_area = (x - center[0]) ** 2 + (y - center[1]) ** 2 <= r*r
-            mask_fft[mask_area] = 0
+            # Normalize each channel to 0-255 range
+            low = img_back.min(axis=(0, 1))
+            span = img_back.max(axis=(0, 1)) - low
+            scale = np.divide(255.0, span, out=np.zeros_like(span), where=span > 0)
+            return ((img_back - low) * scale).astype(np.uint8)
+        
+        return self._process_roi(frame, mask, roi, margin, fill)
+    
+    def _exemplar_patches(self, image, positions, size):
+        """Gather size x size windows with top-left corners at positions (N, 2) as float32"""
+        offsets = np.arange(size)
+        rows = positions[:, 0, np.newaxis] + offsets
+        cols = positions[:, 1, np.newaxis] + offsets
+        return image[rows[:, :, np.newaxis], cols[:, np.newaxis, :]].astype(np.float32)
+    
+    def remove_watermark_exemplar(self, frame, mask, patch_size=9, roi=None, overlap=3, search_band=32,
+                                  iterations=2, reuse_field=True):
+        """
+        Remove watermark using exemplar-based inpainting (similar to Photoshop's content-aware fill)
+        
+        The masked box is tiled into patch_size squares. Each tile is matched, together with a
+        border of overlap pixels, against watermark-free patches inside a search band around the
+        box using PatchMatch (random initialisation, propagation of the offsets of neighbouring
+        tiles and a shrinking random search), and the best source patch is copied into the tile.
+        The resulting nearest-neighbour field can seed the next frame, so steady shots converge
+        in a single pass and the fill stays stable from frame to frame.
+        
+        Parameters:
+        - frame: Input video frame (patched in place)
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - patch_size: Size of the tiles copied from the source patches
+        - roi: Optional (x, y, width, height) of the watermark box, derived from the mask if None
+        - overlap: Border of surrounding pixels compared around each tile
+        - search_band: Width of the band around the box that source patches are taken from
+        - iterations: Number of PatchMatch passes per frame
+        - reuse_field: Start from the previous frame's nearest-neighbour field when the box matches
+        
+        Returns:
+        - Processed frame with watermark removed
+        """
+        size = patch_size + 2 * overlap
+        
+        def fill(crop, mask_crop):
+            masked = mask_crop > 0
+            ys, xs = np.nonzero(masked)
+            if len(ys) == 0:
+                return crop
+            rows, cols = masked.shape
             
-            # Apply the filter
-            f_shift_filtered = f_shift * mask_fft
+            # Pad by the overlap so every tile has a full comparison window; the bottom and right
+            # get a whole extra patch because a box thinner than a patch at the frame edge still
+            # gets a full tile. The padding is treated as part of the hole, so source patches
+            # always lie inside the crop.
+            def pad(image, border, value=0):
+                return cv2.copyMakeBorder(image, overlap, overlap + patch_size, overlap, overlap + patch_size,
+                                          border, value=value)
             
-            # Inverse FFT
-            f_ishift = np.fft.ifftshift(f_shift_filtered)
-            img_back = np.fft.ifft2(f_ishift)
-            img_back = np.abs(img_back)
+            hole = pad(masked.astype(np.uint8), cv2.BORDER_CONSTANT, 1)
+            inside = 1 - pad(np.zeros((rows, cols), np.float32), cv2.BORDER_CONSTANT, 1)
+            source = pad(crop, cv2.BORDER_REFLECT)
             
-            # Normalize to 0-255 range
-            img_back = cv2.normalize(img_back, None, 0, 255, cv2.NORM_MINMAX)
+            # Top-left corners of windows that contain no hole pixel
+            counts = cv2.integral(hole)
+            valid = (counts[size:, size:] - counts[:-size, size:] - counts[size:, :-size] + counts[:-size, :-size]) == 0
+            candidates = np.argwhere(valid)
+            if len(candidates) == 0:
+                return cv2.inpaint(crop, mask_crop, 3, cv2.INPAINT_TELEA)
+            limit = np.array(valid.shape) - 1
             
-            # Store the processed channel
-            result[:, :, c] = img_back
+            # Tiles covering the masked box, the last row and column are pulled back inside it.
+            # A tile's window top-left in padded coordinates equals its top-left in the crop.
+            y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+            tile_rows = np.minimum(np.arange(y0, y1, patch_size), max(y0, y1 - patch_size))
+            tile_cols = np.minimum(np.arange(x0, x1, patch_size), max(x0, x1 - patch_size))
+            grid = np.stack(np.meshgrid(tile_rows, tile_cols, indexing='ij'), axis=-1)
+            tiles = grid.reshape(-1, 2)
+            tile_size = (min(patch_size, y1 - y0), min(patch_size, x1 - x0))
+            weights = self._exemplar_patches(inside[:, :, np.newaxis], tiles, size)
+            
+            def paste(field):
+                patched = crop.copy()
+                for (ty, tx), (sy, sx) in zip(tiles, field + overlap):
+                    patched[ty:ty + tile_size[0], tx:tx + tile_size[1]] = \
+                        source[sy:sy + tile_size[0], sx:sx + tile_size[1]]
+                return patched
+            
+            # Start from the previous frame's field if it was built for the same box
+            state = self._exemplar_field if reuse_field else None
+            rng = np.random.default_rng()
+            if state is not None and state['shape'] == crop.shape and np.array_equal(state['tiles'], tiles):
+                field = state['field'].copy()
+                estimate = paste(field)
+            else:
+                field = candidates[rng.integers(len(candidates), size=len(tiles))]
+                estimate = cv2.inpaint(crop, mask_crop, 3, cv2.INPAINT_TELEA)
+            
+            for _ in range(iterations):
+                padded = pad(estimate, cv2.BORDER_REFLECT)
+                targets = self._exemplar_patches(padded, tiles, size)
+                
+                def cost(positions):
+                    positions = np.clip(positions, 0, limit)
+                    distance = ((self._exemplar_patches(source, positions, size) - targets) ** 2 * weights).sum(axis=(1, 2, 3))
+                    distance[~valid[positions[:, 0], positions[:, 1]]] = np.inf
+                    return positions, distance
+                
+                field, best = cost(field)
+                
+                def consider(positions):
+                    positions, distance = cost(positions)
+                    better = distance < best
+                    field[better] = positions[better]
+                    best[better] = distance[better]
+                
+                # Propagation: try each neighbouring tile's offset
+                offsets = (field - tiles).reshape(grid.shape)
+                for axis in (0, 1):
+                    for shift in (1, -1):
+                        neighbour = np.roll(offsets, shift, axis=axis).reshape(-1, 2)
+                        consider(tiles + neighbour)
+                
+                # Random search in a window that halves around the best match so far
+                radius = search_band
+                while radius >= 1:
+                    consider(field + rng.integers(-radius, radius + 1, size=field.shape))
+                    radius //= 2
+                
+                estimate = paste(field)
+            
+            if reuse_field:
+                self._exemplar_field = {'shape': crop.shape, 'tiles': tiles, 'field': field}
+            return estimate
+        
+        # Source patches come from a band around the box
+        return self._process_roi(frame, mask, roi, search_band, fill)
+    
+    def reset_temporal_state(self):
+        """Forget the background plate and exemplar field so the next frame starts a new shot"""
+        self._temporal_state = None
+        self._exemplar_field = None
+    
+    def _temporal_fill(self, crop, mask_crop, threshold, reach, radius):
+        """Patch one crop for remove_watermark_temporal, updating the background plate"""
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * reach + 1, 2 * reach + 1))
+        masked = mask_crop > 0
+        gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        state = self._temporal_state
+        
+        # No usable history: inpaint the whole region and start a new plate
+        if state is None or state['plate'].shape != crop.shape:
+            self._temporal_state = {
+                'plate': cv2.inpaint(crop, mask_crop, radius, cv2.INPAINT_TELEA),
+                'reference': gray
+            }
+            return self._temporal_state['plate']
+        
+        # Surrounding pixels that changed since the plate was filled
+        changed = (cv2.absdiff(gray, state['reference']) > threshold) & ~masked
+        if not changed.any():
+            return state['plate']
         
-        return result.astype(np.uint8)
+        # Plate pixels close to a change are stale and are inpainted again, using the
+        # current surroundings and the rest of the plate as known pixels
+        stale = (cv2.dilate(changed.astype(np.uint8), kernel) > 0) & masked
+        if stale.any():
+            source = np.where(masked[:, :, np.newaxis], state['plate'], crop)
+            refreshed = cv2.inpaint(source, stale.astype(np.uint8) * 255, radius, cv2.INPAINT_TELEA)
+            state['plate'][stale] = refreshed[stale]
+        state['reference'][changed] = gray[changed]
+        return state['plate']
     
-    def remove_watermark_exemplar(self, frame, mask, patch_size=9):
+    def remove_watermark_temporal(self, frame, mask, roi=None, threshold=12, reach=16, margin=8, radius=3):
         """
-        Remove watermark using exemplar-based inpainting (similar to Photoshop's content-aware fill)
+        Remove watermark by reusing a background plate built from earlier frames
+        
+        The masked region is inpainted once and the result is kept as a plate. Later frames
+        reuse the plate and only re-inpaint the parts of it next to surrounding pixels that
+        changed since the plate was filled, so static shots cost a frame difference instead
+        of an inpaint and the fill does not flicker. Frames must be passed in order.
+        
+        Parameters:
+        - frame: Input video frame (patched in place)
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Optional (x, y, width, height) of the watermark box, derived from the mask if None
+        - threshold: Grayscale difference above which a surrounding pixel counts as changed
+        - reach: Distance in pixels over which a change invalidates the plate
+        - margin: Border of surrounding pixels watched for changes
+        - radius: Inpainting neighbourhood radius for refreshed parts of the plate
+        
+        Returns:
+        - Processed frame with watermark removed
+        """
+        def fill(crop, mask_crop):
+            return self._temporal_fill(crop, mask_crop, threshold, reach, radius)
+        
+        return self._process_roi(frame, mask, roi, max(margin, 2 * radius + 1), fill)
+    
+    def _remove_watermark_frame(self, frame, mask, method, roi):
+        """
+        Apply the selected watermark removal method to a single frame
         
         Parameters:
-        - frame: Input video frame
+        - frame: Input video frame (patched in place)
         - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
-        - patch_size: Size of patches for exemplar-based inpainting
+        - method: Watermark removal method ('inpaint', 'blend', 'frequency', 'exemplar' or 'temporal')
+        - roi: Tuple of (x, y, width, height) for the watermark box
         
         Returns:
         - Processed frame with watermark removed
         """
-        # This is a simplified version of exemplar-based inpainting
-        # For a full implementation, more complex algorithms like PatchMatch would be needed
+        # Only the watermark box plus each method's margin is processed
+        if method == 'inpaint':
+            return self.remove_watermark_inpaint(frame, mask, roi=roi)
+        elif method == 'blend':
+            return self.remove_watermark_blend(frame, mask, roi=roi)
+        elif method == 'frequency':
+            return self.remove_watermark_frequency(frame, mask, roi=roi)
+        elif method == 'exemplar':
+            return self.remove_watermark_exemplar(frame, mask, roi=roi)
+        elif method == 'temporal':
+            return self.remove_watermark_temporal(frame, mask, roi=roi)
+        else:
+            # Default to inpaint
+            return self.remove_watermark_inpaint(frame, mask, roi=roi)
+    
+    def _process_roi_batch(self, frames, mask, roi, margin, fill):
+        """
+        Run a batch removal function on the watermark box plus a margin of every frame
+        
+        Parameters:
+        - frames: Array of shape (n, height, width, 3) (modified in place)
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Tuple of (x, y, width, height) for the watermark box, or None to derive it from the mask
+        - margin: Number of border pixels the removal function needs around the box
+        - fill: Function taking (crops, mask_crop) and returning the patched crops
+        
+        Returns:
+        - The input frames with the watermark region patched
+        """
+        if roi is None:
+            roi = cv2.boundingRect(mask)
+        
+        # Same box arithmetic as _process_roi, shared by all frames of the batch
+        rows, cols = frames.shape[1:3]
+        x, y, w, h = roi
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(cols, x + w), min(rows, y + h)
+        if x1 <= x0 or y1 <= y0 or len(frames) == 0:
+            return frames
+        
+        x0, y0 = max(0, x0 - margin), max(0, y0 - margin)
+        x1, y1 = min(cols, x1 + margin), min(rows, y1 + margin)
+        crops = frames[:, y0:y1, x0:x1]
+        mask_crop = mask[y0:y1, x0:x1]
+        
+        patched = fill(crops, mask_crop)
+        np.copyto(crops, patched, where=(mask_crop > 0)[np.newaxis, :, :, np.newaxis])
+        return frames
+    
+    def process_batch(self, frames, mask, method='blend', roi=None):
+        """
+        Remove the watermark from a batch of frames
+        
+        Blend, frequency and temporal work on the whole batch with one blur, FFT or frame
+        difference call instead of one call per frame. Other methods are applied frame by frame.
+        Results match the per-frame methods with their default parameters.
+        
+        Parameters:
+        - frames: Array of shape (n, height, width, 3), e.g. from read_frame_batches (patched in place)
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - method: Watermark removal method ('inpaint', 'blend', 'frequency', 'exemplar' or 'temporal')
+        - roi: Tuple of (x, y, width, height) for the watermark box, derived from the mask if None
+        
+        Returns:
+        - The processed frames
+        """
+        if method == 'blend':
+            kernel_size = 25
+            
+            def fill(crops, mask_crop):
+                n, h, w = crops.shape[:3]
+                
+                # Stack the frames along the channel axis so one blur covers many of them
+                # (OpenCV images carry at most 128 channels)
+                chunk = 128 // 3
+                blur = np.empty_like(crops)
+                for start in range(0, n, chunk):
+                    part = crops[start:start + chunk]
+                    stacked = np.ascontiguousarray(part.transpose(1, 2, 0, 3)).reshape(h, w, -1)
+                    blurred = cv2.GaussianBlur(stacked, (kernel_size, kernel_size), 0)
+                    blur[start:start + chunk] = blurred.reshape(h, w, len(part), 3).transpose(2, 0, 1, 3)
+                
+                weights = self._blend_weights(mask_crop)
+                if weights is None:
+                    return blur
+                # Same blend call as remove_watermark_blend, so soft masks round the same way
+                for index in range(n):
+                    blur[index] = cv2.blendLinear(crops[index], blur[index], weights[0], weights[1])
+                return blur
+            
+            return self._process_roi_batch(frames, mask, roi, kernel_size // 2, fill)
+        
+        if method == 'frequency':
+            margin, radius = 16, 30
+            
+            frame_rows, frame_cols = frames.shape[1:3]
+            
+            def fill(crops, mask_crop):
+                rows, cols = crops.shape[1:3]
+                high_pass = self._frequency_filter(rows, cols, radius, frame_rows, frame_cols)
+                high_pass = high_pass[np.newaxis, :, :, np.newaxis]
+                
+                # One transform per group of frames (larger groups fall out of cache and get slower)
+                chunk = 8
+                patched = np.empty_like(crops)
+                for start in range(0, len(crops), chunk):
+                    f_transform = np.fft.rfft2(crops[start:start + chunk], axes=(1, 2))
+                    f_transform *= high_pass
+                    img_back = np.abs(np.fft.irfft2(f_transform, s=(rows, cols), axes=(1, 2)))
+                    
+                    # Normalize each channel of each frame to 0-255 range
+                    low = img_back.min(axis=(1, 2), keepdims=True)
+                    span = img_back.max(axis=(1, 2), keepdims=True) - low
+                    scale = np.divide(255.0, span, out=np.zeros_like(span), where=span > 0)
+                    patched[start:start + chunk] = (img_back - low) * scale
+                return patched
+            
+            return self._process_roi_batch(frames, mask, roi, margin, fill)
+        
+        if method == 'temporal':
+            threshold, reach, margin, radius = 12, 16, 8, 3
+            
+            def fill(crops, mask_crop):
+                n, h, w = crops.shape[:3]
+                masked = mask_crop > 0
+                grays = cv2.cvtColor(crops.reshape(n * h, w, 3), cv2.COLOR_BGR2GRAY).reshape(n, h, w)
+                patched = np.empty_like(crops)
+                
+                index = 0
+                while index < n:
+                    state = self._temporal_state
+                    if state is not None and state['plate'].shape == crops.shape[1:]:
+                        # Frames up to the first change around the box all reuse the plate
+                        diff = np.abs(grays[index:].astype(np.int16) - state['reference'])
+                        changed = ((diff > threshold) & ~masked).any(axis=(1, 2))
+                        still = int(np.argmax(changed)) if changed.any() else n - index
+                        patched[index:index + still] = state['plate']
+                        index += still
+                        if index == n:
+                            break
+                    
+                    # The first changed frame goes through the per-frame path, which updates the plate
+                    patched[index] = self._temporal_fill(crops[index], mask_crop, threshold, reach, radius)
+                    index += 1
+                return patched
+            
+            return self._process_roi_batch(frames, mask, roi, max(margin, 2 * radius + 1), fill)
+        
+        # Methods without a batched form
+        for frame in frames:
+            self._remove_watermark_frame(frame, mask, method, roi)
+        return frames
+    
+    def _report_progress(self, callback, frame_number, frame_count, start_time):
+        """
+        Report progress through the callback roughly once per percent
+        
+        Parameters:
+        - callback: Optional callback function taking (progress, remaining_time)
+        - frame_number: Number of frames written so far
+        - frame_count: Total number of frames in the video
+        - start_time: Time at which frame processing started
+        """
+        if callback and frame_number % max(1, int(frame_count / 100)) == 0:
+            progress = int((frame_number / frame_count) * 100)
+            elapsed_time = time.time() - start_time
+            remaining_frames = frame_count - frame_number
+            
+            # Estimate remaining time
+            if frame_number > 0 and elapsed_time > 0:
+                frames_per_second = frame_number / elapsed_time
+                estimated_remaining_time = remaining_frames / frames_per_second
+                callback(progress, estimated_remaining_time)
+            else:
+                callback(progress, None)
+    
+    def _process_frames_pipelined(self, frames, out, method, mask, roi, workers, queue_size, on_frame_written,
+                                  roi_cache=None, profiler=None):
+        """
+        Run decode, watermark removal and encode concurrently
+        
+        A reader thread decodes frames into a bounded queue, a pool of worker threads
+        applies the removal method (OpenCV releases the GIL while it works) and the
+        calling thread acts as the writer, restoring frame order before encoding.
+        
+        Parameters:
+        - frames: Iterator over the frames to process
+        - out: Opened cv2.VideoWriter
+        - method: Watermark removal method
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Tuple of (x, y, width, height) for the watermark box
+        - workers: Number of worker threads
+        - queue_size: Maximum number of frames waiting in each queue
+        - on_frame_written: Function called with the number of frames written so far
+        - roi_cache: Optional RoiCache; frames it matches skip the workers and get the cached box from the writer
+        - profiler: Optional StageProfiler timing the 'method' and 'write' stages
+        
+        Returns:
+        - Number of frames written
+        
+        Raises:
+        - The first exception raised while reading or processing frames
+        """
+        if profiler is None:
+            profiler = StageProfiler(enabled=False)
+        read_queue = queue.Queue(maxsize=queue_size)
+        write_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        
+        def put(q, item):
+            # Block on a full queue without missing a stop request
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def get(q):
+            # Block on an empty queue without missing a stop request
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+        
+        def reader():
+            profiler.register_thread()
+            index = 0
+            try:
+                for frame in frames:
+                    # Lookups happen here, in frame order; the writer applies hits in the same order
+                    hit = roi_cache is not None and roi_cache.matches(frame)
+                    if stop.is_set() or not put(read_queue, (index, frame, hit)):
+                        return
+                    index += 1
+            except Exception as e:
+                # Decoding errors reach the writer, which re-raises them like worker errors
+                put(write_queue, (index, e, False))
+            finally:
+                # One end marker per worker
+                for _ in range(workers):
+                    if not put(read_queue, None):
+                        return
+        
+        def worker():
+            profiler.register_thread()
+            while True:
+                item = get(read_queue)
+                if item is None:
+                    put(write_queue, None)
+                    return
+                index, frame, hit = item
+                try:
+                    if hit:
+                        processed_frame = frame
+                    else:
+                        with profiler.measure('method'):
+                            processed_frame = self._remove_watermark_frame(frame, mask, method, roi)
+                except Exception as e:
+                    put(write_queue, (index, e, False))
+                    return
+                if not put(write_queue, (index, processed_frame, hit)):
+                    return
+        
+        threads = [threading.Thread(target=reader, daemon=True)]
+        threads += [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        
+        # Write frames in their original order as they complete
+        pending = {}
+        next_index = 0
+        finished_workers = 0
+        try:
+            while finished_workers < workers:
+                item = write_queue.get()
+                if item is None:
+                    finished_workers += 1
+                    continue
+                index, processed_frame, hit = item
+                if isinstance(processed_frame, Exception):
+                    raise processed_frame
+                pending[index] = (processed_frame, hit)
+                while next_index in pending:
+                    processed_frame, hit = pending.pop(next_index)
+                    if hit:
+                        processed_frame = roi_cache.apply(processed_frame)
+                    elif roi_cache is not None:
+                        roi_cache.store(processed_frame)
+                    with profiler.measure('write'):
+                        out.write(processed_frame)
+                    next_index += 1
+                    on_frame_written(next_index)
+        finally:
+            stop.set()
+            # Unblock any thread still waiting on a queue
+            for q in (read_queue, write_queue):
+                while not q.empty():
+                    q.get_nowait()
+            for thread in threads:
+                thread.join()
+        
+        return next_index
+    
+    def _find_segment_starts(self, input_path, frame_count, segments):
+        """
+        Split a video into frame ranges, preferring cuts on keyframes
+        
+        Parameters:
+        - input_path: Path to input video file
+        - frame_count: Total number of frames in the video
+        - segments: Desired number of ranges
+        
+        Returns:
+        - Sorted list of first frame indices, one per range, starting with 0
+        """
+        step = frame_count / segments
+        starts = [int(round(i * step)) for i in range(segments)]
+        
+        # Keyframe positions from ffprobe (in decode order, which matches display order at keyframes)
+        keyframes = []
+        if shutil.which('ffprobe'):
+            try:
+                probe = subprocess.run(
+                    ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                     '-show_entries', 'packet=flags', '-of', 'csv=p=0', input_path],
+                    capture_output=True, text=True, check=True
+                )
+                keyframes = [i for i, flags in enumerate(probe.stdout.split()) if 'K' in flags]
+            except (subprocess.CalledProcessError, OSError):
+                keyframes = []
+        
+        # Snap each cut to the nearest keyframe so every range starts with a cheap seek
+        if keyframes:
+            starts = [0] + [min(keyframes, key=lambda k: abs(k - start)) for start in starts[1:]]
+        
+        return sorted(set(start for start in starts if start < frame_count)) or [0]
+    
+    def _process_segments(self, input_path, output_path, method, watermark_coords, fps, size, frame_count,
+                          segments, callback=None, encoding=None, roi_cache_tolerance=None, stats=None, profiler=None):
+        """
+        Process frame ranges in a process pool and join the parts without re-encoding
+        
+        Parameters:
+        - input_path: Path to input video file
+        - output_path: Path to save output video file
+        - method: Watermark removal method
+        - watermark_coords: Tuple of (x, y, width, height) for watermark location
+        - fps: Frame rate of the output
+        - size: (width, height) of the output
+        - frame_count: Total number of frames in the video
+        - segments: Number of frame ranges
+        - callback: Optional callback function to report progress
+        - encoding: Keyword arguments for open_video_writer
+        - roi_cache_tolerance: Tolerance of each segment's RoiCache (None to disable)
+        - stats: Optional dictionary filled with processing statistics
+        - profiler: Optional StageProfiler; the segments' stage timings are merged into it
+        
+        Returns:
+        - (success, message): Tuple indicating success status and message
+        """
+        if profiler is None:
+            profiler = StageProfiler(enabled=False)
+        encoding = dict(encoding or {})
+        with_audio = encoding.get('encoder') == 'ffmpeg'
+        with profiler.measure('seek'):
+            starts = self._find_segment_starts(input_path, frame_count, segments)
+        part_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(os.path.abspath(output_path)))
+        part_paths = [os.path.join(part_dir, f"part_{i:03d}.mp4") for i in range(len(starts))]
         
-        # Convert mask to binary (0 for watermark, 1 for non-watermark)
-        mask_inv = cv2.bitwise_not(mask)
-        mask_inv = mask_inv.astype(np.uint8) // 255
+        try:
+            # The last range reads to the end of the file so no trailing frames are lost
+            ranges = [
+                (start, starts[i + 1] - start if i + 1 < len(starts) else None)
+                for i, start in enumerate(starts)
+            ]
+            
+            frames_done = 0
+            start_time = time.time()
+            executor = segment_pool()
+            futures = [
+                executor.submit(_process_segment, input_path, part_path, method, watermark_coords,
+                                fps, size, start, count, encoding, roi_cache_tolerance, profiler.enabled)
+                for part_path, (start, count) in zip(part_paths, ranges)
+            ]
+            try:
+                for future in as_completed(futures):
+                    frames_written, cache_hits, stages = future.result()
+                    profiler.merge(stages)
+                    frames_done += frames_written
+                    if stats is not None:
+                        stats['frames'] = frames_done
+                        stats['roi_cache_hits'] = stats.get('roi_cache_hits', 0) + cache_hits
+                        stats['roi_cache_hit_rate'] = stats['roi_cache_hits'] / frames_done if frames_done else 0.0
+                    if callback:
+                        progress = min(100, int((frames_done / max(1, frame_count)) * 100))
+                        elapsed_time = time.time() - start_time
+                        frames_per_second = frames_done / elapsed_time if elapsed_time > 0 else 0
+                        if frames_per_second > 0:
+                            callback(progress, max(0, frame_count - frames_done) / frames_per_second)
+                        else:
+                            callback(progress, None)
+            finally:
+                # The pool is shared, so ranges of a failed run are cancelled or waited for
+                # before their part files are removed
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+            
+            # Join the parts in range order so the output matches the sequential path
+            join_start = time.perf_counter()
+            if shutil.which('ffmpeg'):
+                list_path = os.path.join(part_dir, 'parts.txt')
+                with open(list_path, 'w') as f:
+                    for part_path in part_paths:
+                        f.write(f"file '{part_path}'\n")
+                concat_cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+                if with_audio:
+                    # Copy the original audio track alongside the joined video
+                    concat_cmd += ['-i', input_path, '-map', '0:v:0', '-map', '1:a:0?']
+                concat_cmd += ['-c', 'copy', output_path]
+                subprocess.run(concat_cmd, check=True)
+            else:
+                # Without FFmpeg the parts are decoded and written once more with OpenCV
+                out = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+                try:
+                    for part_path in part_paths:
+                        part = cv2.VideoCapture(part_path)
+                        try:
+                            while True:
+                                ret, frame = part.read()
+                                if not ret:
+                                    break
+                                out.write(frame)
+                        finally:
+                            part.release()
+                finally:
+                    out.release()
+            profiler.add('join', time.perf_counter() - join_start)
+        except (subprocess.CalledProcessError, OSError) as e:
+            return False, f"Error: Could not join video segments ({e})"
+        except BrokenProcessPool as e:
+            _discard_segment_pool(executor)
+            return False, f"Error: A segment worker process stopped unexpectedly ({e})"
+        except RuntimeError as e:
+            return False, f"Error: {e}"
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+        
+        return True, "Watermark removal completed successfully"
+    
+    def roi_margin(self, method):
+        """Border around the watermark box that a method reads (unknown methods fall back to inpaint)"""
+        return self.METHOD_MARGINS.get(method, self.METHOD_MARGINS['inpaint'])
+    
+    def _select_auto_method(self, samples, mask, roi, frame_count, parallelism=1, time_budget=None, min_fps=None):
+        """
+        Pick the best-quality method whose estimated cost fits a time budget and an fps target
         
-        # Process each channel separately
-        result = np.zeros_like(frame)
+        Candidates are timed on the sample frames in AUTO_METHODS order (after one untimed
+        warm-up call, so per-video setup such as the exemplar field is not counted), stopping at
+        the first that fits. The removal time of the video is estimated as frame_count times the
+        median time per frame, divided by the parallelism; decoding and encoding are left out
+        because they cost the same whichever method runs. Method cost scales with the watermark
+        box rather than the frame, which is why the samples are timed on the real box.
         
-        for c in range(3):  # For each color channel
-            # Get the current channel
-            channel = frame[:, :, c]
+        Parameters:
+        - samples: Frames to time the methods on (left unmodified)
+        - mask: Binary mask where watermark is located (255 for watermark, 0 elsewhere)
+        - roi: Tuple of (x, y, width, height) for the watermark box
+        - frame_count: Total number of frames in the video
+        - parallelism: Number of frames processed at the same time
+        - time_budget: Seconds of removal work the video may take, or None for no limit
+        - min_fps: Frames per second the method must sustain, or None for no limit
+        
+        Returns:
+        - (method, estimates): The chosen method (the cheapest candidate if none fits) and, for every
+          timed method, a dictionary with ms_per_frame, fps and seconds
+        """
+        estimates = {}
+        if not samples:
+            return self.AUTO_METHODS[-1], estimates
+        
+        for method in self.AUTO_METHODS:
+            # A fresh instance keeps the timing runs' state out of the real run
+            remover = type(self)()
+            remover._remove_watermark_frame(samples[0].copy(), mask, method, roi)
+            times = []
+            for sample in samples:
+                frame = sample.copy()
+                start = time.perf_counter()
+                remover._remove_watermark_frame(frame, mask, method, roi)
+                times.append(time.perf_counter() - start)
             
-            # Apply exemplar-based inpainting (simplified version)
-            # Here we use a median filter as a simple approximation
-            filled = ndimage.median_filter(channel, size=patch_size)
+            per_frame = max(float(np.median(times)), 1e-6)
+            fps = parallelism / per_frame
+            seconds = frame_count * per_frame / parallelism
+            estimates[method] = {'ms_per_frame': round(1000.0 * per_frame, 3), 'fps': round(fps, 2),
+                                 'seconds': round(seconds, 2)}
+            if (time_budget is None or seconds <= time_budget) and (min_fps is None or fps >= min_fps):
+                return method, estimates
+        
+        return self.AUTO_METHODS[-1], estimates
+    
+    def _default_watermark_coords(self, width, height):
+        """Fallback watermark box when detection fails: bottom right corner, 20% of width and 10% of height"""
+        w_width = int(width * 0.2)
+        w_height = int(height * 0.1)
+        return (width - w_width, height - w_height, w_width, w_height)
+    
+    def preview(self, input_path, methods=('inpaint',), watermark_coords=None, samples=4, max_width=640,
+                crop_margin=None, max_grab=250, warmup=4):
+        """
+        Dry run of one or more removal methods on a few frames spread over the video
+        
+        Only the sampled frames are decoded: frames in between are skipped with grab(), or with
+        a seek when the gap is longer than max_grab. Samples are downscaled to max_width before
+        the methods run on the watermark box, so a preview takes about a second even for long
+        videos. Timings are measured at the preview size.
+        
+        Parameters:
+        - input_path: Path to input video file
+        - methods: Removal methods to compare ('inpaint', 'blend', 'frequency', 'exemplar', 'temporal')
+        - watermark_coords: Tuple of (x, y, width, height) at full resolution, or None to detect it
+          on the sampled frames
+        - samples: Number of frames to preview
+        - max_width: Width the samples are downscaled to (None to keep full resolution)
+        - crop_margin: If set, thumbnails show only the watermark box plus this many pixels around it
+        - max_grab: Longest gap between samples that is skipped with grab() instead of a seek
+        - warmup: Frames decoded before each sample to give the temporal method a history
+        
+        Returns:
+        - Dictionary with 'watermark_coords' (full resolution), 'roi' (at preview scale), 'scale',
+          'fps', 'decode_seconds', 'timings' (milliseconds per frame by method) and 'frames', a list
+          of {'index', 'before', 'after': {method: image}} with BGR images; None if no frame could be read
+        """
+        cap = cv2.VideoCapture(input_path)
+        if not cap.isOpened():
+            return None
+        
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        
+        scale = min(1.0, max_width / width) if max_width and width > 0 else 1.0
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        lead = warmup if 'temporal' in methods else 0
+        if frame_count > 0:
+            indices = sorted({int(i) for i in np.linspace(0, frame_count - 1, max(1, min(samples, frame_count)))})
+        else:
+            indices = list(range(samples))
+        
+        # Decode each sample (and its warmup frames) only
+        decode_start = time.perf_counter()
+        clips = []
+        position = 0
+        for index in indices:
+            first = max(position, index - lead)
+            if first - position > max_grab:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+                position = first
+            while position < first and cap.grab():
+                position += 1
             
-            # Combine the original and filled regions using the mask
-            result[:, :, c] = channel * mask_inv + filled * (1 - mask_inv)
+            frames = []
+            while position <= index:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                position += 1
+                if scale < 1.0:
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                frames.append(frame)
+            if position != index + 1:
+                break
+            clips.append((index, frames))
+        cap.release()
+        decode_seconds = time.perf_counter() - decode_start
         
-        return result.astype(np.uint8)
+        if not clips:
+            return None
+        
+        # Locate the watermark at preview scale
+        if watermark_coords is None:
+            detector = StreamingWatermarkDetector()
+            for _, frames in clips:
+                detector.update(frames[-1])
+            roi = detector.detect() or self._default_watermark_coords(*size)
+            watermark_coords = tuple(int(round(value / scale)) for value in roi)
+        else:
+            x, y, w, h = watermark_coords
+            roi = (int(x * scale), int(y * scale), max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        mask = create_mask(size[0], size[1], roi)
+        
+        def thumbnail(image):
+            if crop_margin is None:
+                return image
+            x, y, w, h = roi
+            return image[max(0, y - crop_margin):y + h + crop_margin, max(0, x - crop_margin):x + w + crop_margin]
+        
+        results = [{'index': index, 'before': thumbnail(frames[-1]).copy(), 'after': {}} for index, frames in clips]
+        timings = {}
+        for method in methods:
+            elapsed = 0.0
+            for result, (_, frames) in zip(results, clips):
+                # Samples are unrelated frames, so no state is carried between them
+                self.reset_temporal_state()
+                if method == 'temporal':
+                    for frame in frames[:-1]:
+                        self.remove_watermark_temporal(frame.copy(), mask, roi=roi)
+                frame = frames[-1].copy()
+                start = time.perf_counter()
+                processed = self._remove_watermark_frame(frame, mask, method, roi)
+                elapsed += time.perf_counter() - start
+                result['after'][method] = thumbnail(processed)
+            timings[method] = round(1000.0 * elapsed / len(clips), 3)
+        self.reset_temporal_state()
+        
+        return {
+            'watermark_coords': tuple(watermark_coords),
+            'roi': roi,
+            'scale': scale,
+            'fps': fps,
+            'decode_seconds': round(decode_seconds, 4),
+            'timings': timings,
+            'frames': results
+        }
     
-    def process_video(self, input_path, output_path, method='inpaint', watermark_coords=None, callback=None):
+    def process_video(self, input_path, output_path, method='inpaint', watermark_coords=None, callback=None,
+                      workers=1, queue_size=8, segments=1, detect_in_pass=False, detect_window=150,
+                      encoder='opencv', preset='veryfast', crf=23, roi_cache=False, roi_cache_tolerance=0,
+                      stats=None, batch_size=1, profiler=None, auto_time_budget=None, auto_min_fps=None):
         """
         Process a video to remove watermark
         
         Parameters:
         - input_path: Path to input video file
         - output_path: Path to save output video file
-        - method: Watermark removal method ('inpaint', 'blend', 'frequency', 'exemplar', or 'auto')
+        - method: Watermark removal method ('inpaint', 'blend', 'frequency', 'exemplar', 'temporal', or 'auto')
         - watermark_coords: Tuple of (x, y, width, height) for watermark location
         - callback: Optional callback function to report progress
+        - workers: Number of worker threads; above 1 decoding, processing and encoding run in a pipeline
+        - queue_size: Maximum number of frames buffered between pipeline stages
+        - segments: Number of frame ranges processed in parallel by separate processes (1 to disable)
+        - detect_in_pass: Detect the watermark on the first frames of the main pass instead of a separate prepass
+        - detect_window: Number of leading frames buffered for detection when detect_in_pass is set;
+          the window is further limited to DETECT_WINDOW_BYTES of decoded frames (about 20 at 1080p,
+          under a second of video). If nothing is found in the window, detection falls back to
+          sampling the whole video followed by a rewind, as without detect_in_pass
+        - encoder: 'opencv' for cv2.VideoWriter (mp4v, no audio) or 'ffmpeg' to pipe frames into an
+          H.264 encoder that also copies the input's audio track
+        - preset: x264 preset when encoder is 'ffmpeg'
+        - crf: x264 constant rate factor when encoder is 'ffmpeg'
+        - roi_cache: Reuse the previous patched result while the watermark neighbourhood does not change
+        - roi_cache_tolerance: Largest per-pixel difference the ROI cache still treats as unchanged
+        - stats: Optional dictionary filled with live statistics ('frames', 'roi_cache_hits',
+          'roi_cache_hit_rate') that a progress callback can read
+        - batch_size: Number of frames decoded into a shared buffer and processed together when
+          running on a single worker without the ROI cache (1 to disable)
+        - profiler: Optional StageProfiler timing the seek, sample, detect, auto, read, method and write
+          stages (plus join for segments); its report is also stored in stats['profile']
+        - auto_time_budget: Seconds of removal work an 'auto' run may take (None for no limit)
+        - auto_min_fps: Frames per second the method chosen by 'auto' must sustain (None for no limit)
+        
+        'auto' times the candidate methods on a few frames and picks the best-quality one that
+        fits auto_time_budget and auto_min_fps (see _select_auto_method); with stats given, the
+        choice and the estimates are stored in stats['auto_method'] and stats['auto_estimates'].
+        
+        When stats is given and processing succeeds, stats['metadata'] receives probe_video() of
+        the output, so callers can index the result without opening it again.
         
         Returns:
         - (success, message): Tuple indicating success status and message
         """
+        if profiler is None:
+            profiler = StageProfiler(enabled=False)
+        
+        profiler.start()
+        try:
+            success, message = self._process_video(
+                input_path, output_path, method, watermark_coords, callback, workers, queue_size, segments,
+                detect_in_pass, detect_window, encoder, preset, crf, roi_cache, roi_cache_tolerance, stats,
+                batch_size, profiler, auto_time_budget, auto_min_fps
+            )
+            if success and stats is not None:
+                stats['metadata'] = probe_video(output_path)
+            return success, message
+        finally:
+            profiler.stop()
+            if stats is not None and profiler.enabled:
+                stats['profile'] = profiler.report()
+    
+    def process_video_multi(self, input_path, outputs, watermark_coords=None, reference_path=None, callback=None,
+                            encoder='opencv', preset='veryfast', crf=23):
+        """
+        Run several removal methods on one decode of a video, each into its own output
+        
+        Every decoded frame is copied to each method and written by that method's writer, so
+        comparing N methods costs one decode instead of N.
+        
+        Parameters:
+        - input_path: Path to input video file
+        - outputs: Dictionary mapping each method ('inpaint', 'blend', 'frequency', 'exemplar',
+          'temporal') to its output path
+        - watermark_coords: Tuple of (x, y, width, height) for watermark location, or None to detect it
+        - reference_path: Optional clean version of the input (the same frames without the watermark);
+          when given, every method is scored with PSNR and SSIM over the watermark box
+        - callback: Optional callback function to report progress
+        - encoder: 'opencv' or 'ffmpeg', as for process_video
+        - preset: x264 preset when encoder is 'ffmpeg'
+        - crf: x264 constant rate factor when encoder is 'ffmpeg'
+        
+        Quality is measured on the frames handed to the writers, so it reflects the method and not
+        the encoder.
+        
+        Returns:
+        - (success, message, report): report holds 'frames', 'watermark_coords', 'decode_seconds',
+          'input' (quality of the untouched input against the reference, or None) and 'methods', which
+          maps each method to its output_path, seconds, write_seconds, fps, ms_per_frame and quality
+          (psnr and ssim, or None without a reference); report is None if the input cannot be opened
+        """
+        cap = cv2.VideoCapture(input_path)
+        if not cap.isOpened():
+            return False, "Error: Could not open video file", None
+        
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        
+        if watermark_coords is None:
+            watermark_coords = self.detect_watermark_stream(cap, frame_count)
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if watermark_coords is None:
+                watermark_coords = self._default_watermark_coords(width, height)
+        mask = create_mask(width, height, watermark_coords)
+        
+        reference = None
+        if reference_path is not None:
+            reference = cv2.VideoCapture(reference_path)
+            if not reference.isOpened():
+                cap.release()
+                return False, "Error: Could not open reference video file", None
+        
+        # Separate instances keep the temporal and exemplar state of each method apart
+        removers = {method: type(self)() for method in outputs}
+        meters = {method: QualityMeter((height, width), watermark_coords) for method in outputs}
+        input_meter = QualityMeter((height, width), watermark_coords)
+        method_seconds = dict.fromkeys(outputs, 0.0)
+        write_seconds = dict.fromkeys(outputs, 0.0)
+        decode_seconds = 0.0
+        frame_number = 0
+        writers = {}
+        
+        try:
+            for method, output_path in outputs.items():
+                writers[method] = open_video_writer(output_path, fps, (width, height), encoder=encoder,
+                                                    preset=preset, crf=crf, audio_path=input_path)
+            
+            start_time = time.time()
+            while True:
+                start = time.perf_counter()
+                ret, frame = cap.read()
+                clean = None
+                if ret and reference is not None:
+                    # The comparison stops where the reference runs out
+                    ret_reference, clean = reference.read()
+                    if not ret_reference:
+                        clean = None
+                        reference.release()
+                        reference = None
+                decode_seconds += time.perf_counter() - start
+                if not ret:
+                    break
+                if clean is not None:
+                    input_meter.update(frame, clean)
+                
+                for method, remover in removers.items():
+                    start = time.perf_counter()
+                    processed_frame = remover._remove_watermark_frame(frame.copy(), mask, method, watermark_coords)
+                    written = time.perf_counter()
+                    writers[method].write(processed_frame)
+                    method_seconds[method] += written - start
+                    write_seconds[method] += time.perf_counter() - written
+                    if clean is not None:
+                        meters[method].update(processed_frame, clean)
+                
+                frame_number += 1
+                self._report_progress(callback, frame_number, frame_count, start_time)
+        finally:
+            cap.release()
+            if reference is not None:
+                reference.release()
+            for writer in writers.values():
+                writer.release()
+        
+        report = {
+            'frames': frame_number,
+            'watermark_coords': tuple(watermark_coords),
+            'decode_seconds': round(decode_seconds, 4),
+            'input': input_meter.report(),
+            'methods': {
+                method: {
+                    'output_path': outputs[method],
+                    'seconds': round(method_seconds[method], 4),
+                    'write_seconds': round(write_seconds[method], 4),
+                    'fps': round(frame_number / method_seconds[method], 2) if method_seconds[method] > 0 else None,
+                    'ms_per_frame': round(1000.0 * method_seconds[method] / frame_number, 3) if frame_number else None,
+                    'quality': meters[method].report()
+                } for method in outputs
+            }
+        }
+        
+        failed = [f"{method} ({writer.error})" for method, writer in writers.items() if getattr(writer, 'error', None)]
+        if failed:
+            return False, f"Error: Could not encode output video for {', '.join(failed)}", report
+        
+        return True, f"Compared {len(outputs)} methods on {frame_number} frames", report
+    
+    def _process_video(self, input_path, output_path, method, watermark_coords, callback, workers, queue_size,
+                       segments, detect_in_pass, detect_window, encoder, preset, crf, roi_cache,
+                       roi_cache_tolerance, stats, batch_size, profiler, auto_time_budget, auto_min_fps):
+        """Body of process_video, with a (possibly disabled) profiler always set"""
         # Open the video file
         cap = cv2.VideoCapture(input_path)
         if not cap.isOpened():
@@ -210,95 +2096,163 @@ class WatermarkRemover:
         fps = cap.get(cv2.CAP_PROP_FPS)
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         
-        # Create VideoWriter object
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        
-        # If method is 'auto', we'll try to detect the best method based on the video
-        if method == 'auto':
-            # Default to inpaint for now
-            method = 'inpaint'
+        # Frames still to be processed
+        frames = profiler.timed(read_frames(cap), 'read')
+        leading = []
+        # Frames 'auto' times the candidate methods on
+        samples = []
         
         # If watermark coordinates are not provided, try to detect them
         if watermark_coords is None:
-            # Read a sample of frames for watermark detection
-            sample_frames = []
-            max_samples = min(30, frame_count)  # Use at most 30 frames for detection
-            step = max(1, frame_count // max_samples)
-            
-            for i in range(0, frame_count, step):
-                cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-                ret, frame = cap.read()
-                if ret:
-                    sample_frames.append(frame)
-                if len(sample_frames) >= max_samples:
-                    break
-            
-            # Try to detect the watermark
-            watermark_coords = self.detect_watermark(sample_frames)
-            
-            # Reset the video capture to the beginning
-            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            if detect_in_pass and segments <= 1:
+                # Detect on a leading window of the main pass; the window is buffered
+                # and processed once the watermark has been located
+                window = []
+                detector = StreamingWatermarkDetector()
+                window_size = min(detect_window, frame_count) if frame_count > 0 else detect_window
+                window_size = max(1, min(window_size, self.DETECT_WINDOW_BYTES // max(1, width * height * 3)))
+                step = max(1, window_size // 30)
+                for frame in frames:
+                    if len(window) % step == 0:
+                        with profiler.measure('detect'):
+                            detector.update(frame)
+                    window.append(frame)
+                    if len(window) >= window_size:
+                        break
+                with profiler.measure('detect'):
+                    watermark_coords = detector.detect()
+                if watermark_coords is None:
+                    # The window holds under a second of consecutive frames, often too little motion to
+                    # tell a static watermark from a static background; sample the whole video instead
+                    window = None  # Drop the buffered frames before the second pass
+                    with profiler.measure('seek'):
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    watermark_coords = self.detect_watermark_stream(
+                        cap, frame_count, profiler=profiler, samples=samples if method == 'auto' else None
+                    )
+                    with profiler.measure('seek'):
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    frames = profiler.timed(read_frames(cap), 'read')
+                else:
+                    leading = window
+                    frames = itertools.chain(window, frames)
+                    samples = window[::max(1, len(window) // self.AUTO_SAMPLE_FRAMES)][:self.AUTO_SAMPLE_FRAMES]
+            else:
+                # Sample frames in one forward pass, then rewind for processing
+                watermark_coords = self.detect_watermark_stream(
+                    cap, frame_count, profiler=profiler, samples=samples if method == 'auto' else None
+                )
+                with profiler.measure('seek'):
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
             
             # If watermark detection failed, use default coordinates
             if watermark_coords is None:
-                # Default to bottom right corner, 20% of width and 10% of height
-                w_width = int(width * 0.2)
-                w_height = int(height * 0.1)
-                x = width - w_width
-                y = height - w_height
-                watermark_coords = (x, y, w_width, w_height)
-        
-        # Extract watermark coordinates
-        x, y, w, h = watermark_coords
+                watermark_coords = self._default_watermark_coords(width, height)
         
         # Create a mask for the watermark region
-        mask = np.zeros((height, width), dtype=np.uint8)
-        mask[y:y+h, x:x+w] = 255
+        mask = create_mask(width, height, watermark_coords)
         
-        # Process each frame
-        frame_number = 0
-        start_time = time.time()
+        if method == 'auto':
+            if not samples:
+                # The first frames double as samples; they are buffered and processed as usual
+                samples = list(itertools.islice(frames, self.AUTO_SAMPLE_FRAMES))
+                leading = leading + samples
+                frames = itertools.chain(samples, frames)
+            parallelism = segments if segments > 1 else workers
+            parallelism = max(1, min(parallelism, os.cpu_count() or 1))
+            with profiler.measure('auto'):
+                method, estimates = self._select_auto_method(
+                    samples, mask, watermark_coords, frame_count, parallelism, auto_time_budget, auto_min_fps
+                )
+            if stats is not None:
+                stats['auto_method'] = method
+                stats['auto_estimates'] = estimates
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+        encoding = {'encoder': encoder, 'preset': preset, 'crf': crf}
+        
+        if segments > 1:
+            # Hand independent frame ranges to separate processes
+            cap.release()
+            return self._process_segments(
+                input_path, output_path, method, watermark_coords,
+                fps, (width, height), frame_count, segments, callback, encoding,
+                roi_cache_tolerance if roi_cache else None, stats, profiler
+            )
+        
+        # Create the output writer; the capture and writer are released even if processing fails
+        out = None
+        try:
+            out = open_video_writer(output_path, fps, (width, height), audio_path=input_path, **encoding)
             
-            # Apply the selected watermark removal method
-            if method == 'inpaint':
-                processed_frame = self.remove_watermark_inpaint(frame, mask)
-            elif method == 'blend':
-                processed_frame = self.remove_watermark_blend(frame, mask)
-            elif method == 'frequency':
-                processed_frame = self.remove_watermark_frequency(frame, mask)
-            elif method == 'exemplar':
-                processed_frame = self.remove_watermark_exemplar(frame, mask)
-            else:
-                # Default to inpaint
-                processed_frame = self.remove_watermark_inpaint(frame, mask)
+            # The temporal method carries state from frame to frame, so its frames stay in order
+            self.reset_temporal_state()
+            if method == 'temporal':
+                workers = 1
             
-            # Write the processed frame to output video
-            out.write(processed_frame)
+            # Skip frames whose watermark neighbourhood is unchanged
+            cache = None
+            if roi_cache:
+                cache = RoiCache((height, width), watermark_coords, margin=self.roi_margin(method),
+                                 tolerance=roi_cache_tolerance)
+            if stats is None:
+                stats = {}
             
-            # Update progress
-            frame_number += 1
-            if callback and frame_number % max(1, int(frame_count / 100)) == 0:
-                progress = int((frame_number / frame_count) * 100)
-                elapsed_time = time.time() - start_time
-                remaining_frames = frame_count - frame_number
+            # Process each frame
+            start_time = time.time()
+            
+            def on_frame_written(frame_number):
+                stats['frames'] = frame_number
+                if cache is not None:
+                    stats['roi_cache_hits'] = cache.hits
+                    stats['roi_cache_hit_rate'] = cache.hit_rate()
+                self._report_progress(callback, frame_number, frame_count, start_time)
+            
+            if workers > 1:
+                # Overlap decoding, processing and encoding across threads
+                self._process_frames_pipelined(
+                    frames, out, method, mask, watermark_coords, workers, queue_size, on_frame_written, cache,
+                    profiler
+                )
+            elif batch_size > 1 and cache is None:
+                # Decode into a reused buffer and process each batch with one call per method step
+                frame_number = 0
                 
-                # Estimate remaining time
-                if frame_number > 0 and elapsed_time > 0:
-                    frames_per_second = frame_number / elapsed_time
-                    estimated_remaining_time = remaining_frames / frames_per_second
-                    callback(progress, estimated_remaining_time)
-                else:
-                    callback(progress, None)
+                for batch in profiler.timed(read_frame_batches(cap, batch_size, leading), 'read'):
+                    with profiler.measure('method'):
+                        self.process_batch(batch, mask, method, watermark_coords)
+                    for processed_frame in batch:
+                        with profiler.measure('write'):
+                            out.write(processed_frame)
+                        frame_number += 1
+                        on_frame_written(frame_number)
+            else:
+                frame_number = 0
+                
+                for frame in frames:
+                    if cache is not None and cache.matches(frame):
+                        # Reuse the patched box of the last processed frame
+                        processed_frame = cache.apply(frame)
+                    else:
+                        # Apply the selected watermark removal method
+                        with profiler.measure('method'):
+                            processed_frame = self._remove_watermark_frame(frame, mask, method, watermark_coords)
+                        if cache is not None:
+                            cache.store(processed_frame)
+                    
+                    # Write the processed frame to output video
+                    with profiler.measure('write'):
+                        out.write(processed_frame)
+                    
+                    # Update progress
+                    frame_number += 1
+                    on_frame_written(frame_number)
+        finally:
+            cap.release()
+            if out is not None:
+                out.release()
         
-        # Release resources
-        cap.release()
-        out.release()
+        if getattr(out, 'error', None):
+            return False, f"Error: Could not encode output video ({out.error})"
         
         return True, "Watermark removal completed successfully"
 
@@ -327,7 +2281,7 @@ if __name__ == "__main__":
     success, message = remover.process_video(
         input_video,
         output_video,
-        method='inpaint',  # Options: 'inpaint', 'blend', 'frequency', 'exemplar', 'auto'
+        method='inpaint',  # Options: 'inpaint', 'blend', 'frequency', 'exemplar', 'temporal', 'auto'
         watermark_coords=watermark_coords,
         callback=progress_callback
     )